@@ -27,13 +27,28 @@ import threading as _threading
 _log = _logging.getLogger("amqpserver")
 
 class AmqpServer(_threading.Thread):
-    def __init__(self, app, host="", port=5672):
+    def __init__(self, app, host="", port=5672, update_delay=0.1, queue_limit=1000, overflow_policy="keep-latest"):
         super().__init__()
 
         self.app = app
         self.host = host
         self.port = port
 
+        # Updates fired within update_delay seconds of each other are
+        # sent together, and only the latest update for each event
+        # path is sent
+
+        self.update_delay = update_delay
+
+        # Updates wait in a queue for each subscriber link until the
+        # link has credit.  See OutboundQueue for the policies.
+
+        self.queue_limit = queue_limit
+        self.overflow_policy = overflow_policy
+
+        self._pending_updates = dict()
+        self._pending_updates_lock = _threading.Lock()
+
         self.container = _reactor.Container(MessagingHandler(self))
         self.container.container_id = f"stagger-{self.container.container_id}"
 
@@ -45,18 +60,34 @@ class AmqpServer(_threading.Thread):
     def run(self):
         self.container.run()
 
-    def fire_object_update(self, obj):
+    def fire_object_update(self, obj, revision):
         _log.info("Firing update for %s", obj)
 
-        event = _reactor.ApplicationEvent("object_update", subject=obj)
-        self.events.trigger(event)
+        with self._pending_updates_lock:
+            first = not self._pending_updates
+
+            self._pending_updates.pop(obj.event_path, None)
+            self._pending_updates[obj.event_path] = (obj, revision)
+
+        if first:
+            event = _reactor.ApplicationEvent("object_updates")
+            self.events.trigger(event)
+
+    def take_pending_updates(self):
+        with self._pending_updates_lock:
+            updates = self._pending_updates
+            self._pending_updates = dict()
+
+        return updates.values()
 
 class MessagingHandler(_handlers.MessagingHandler):
     def __init__(self, server):
         super().__init__()
 
         self.server = server
-        self.subscriptions = _collections.defaultdict(dict)
+        self.subscriptions = SubscriptionTree()
+        self.queues = dict()
+        self.replays = dict()
 
     def on_start(self, event):
         interface = "{0}:{1}".format(self.server.host, self.server.port)
@@ -79,33 +110,258 @@ class MessagingHandler(_handlers.MessagingHandler):
 
             event.link.source.address = address
 
-            self.subscriptions[address][event.link.name] = event.link
+            self.subscriptions.add(address, event.link)
+            self.queues[event.link] = OutboundQueue(self.server.queue_limit, self.server.overflow_policy)
 
             _log.info("Link opened for '%s'" % address)
 
+            since_revision = _since_revision(event.link)
+
+            if since_revision is not None:
+                event.link.source.filter.put_dict({_since_revision_filter: since_revision})
+                self.replay(event.link, address, since_revision)
+
     def on_link_closing(self, event):
-        if event.link.is_sender:
-            address = event.link.source.address
-            del self.subscriptions[address][event.link.name]
+        self.remove_link(event.link)
+
+    def on_connection_closing(self, event):
+        for link in _links(event.connection):
+            self.remove_link(link)
+
+    def on_disconnected(self, event):
+        for link in _links(event.connection):
+            self.remove_link(link)
+
+    def remove_link(self, link):
+        if link.is_sender and self.queues.pop(link, None) is not None:
+            self.subscriptions.remove(link.source.address, link)
+            self.replays.pop(link, None)
+
+    def on_sendable(self, event):
+        self.drain(event.sender)
+
+    def drain(self, sender):
+        # A replay in progress goes first.  Its messages are made one
+        # at a time as credit arrives.  Live updates wait in the queue
+        # behind it.
+
+        replay = self.replays.get(sender)
+
+        while replay is not None and sender.credit > 0:
+            update = next(replay, None)
 
-    def on_object_update(self, event):
-        obj = event.subject
+            if update is None:
+                del self.replays[sender]
+                replay = None
+            else:
+                sender.send(_update_message(*update))
 
+        if replay is not None:
+            return
+
+        queue = self.queues[sender]
+
+        while sender.credit > 0 and queue:
+            sender.send(queue.pop())
+
+    def on_object_updates(self, event):
+        self.server.container.schedule(self.server.update_delay, self)
+
+    def on_timer_task(self, event):
+        for obj, revision in self.server.take_pending_updates():
+            self.send_update(obj, revision)
+
+    def send_update(self, obj, revision):
         _log.info("Sending updates for %s", obj)
 
-        message = _proton.Message()
-        message.content_type = "application/json"
-        message.inferred = True
-        message.properties = {
-            "type": obj.type_name,
-            "path": obj.event_path,
-        }
-        message.body = obj.json().encode("utf-8")
-
-        for sender in self.subscriptions[obj.event_path].values():
-            if sender.credit > 0:
-                sender.send(message)
-
-        for sender in self.subscriptions["events"].values():
-            if sender.credit > 0:
-                sender.send(message)
+        message = _update_message(obj, revision)
+
+        for sender in self.subscriptions.match(obj.event_path):
+            self.queues[sender].push(obj.event_path, message)
+            self.drain(sender)
+
+    def replay(self, sender, address, since_revision):
+        """
+        Send the current state of each object under address that
+        changed after since_revision.  If those changes are no longer
+        known, send every object under address instead.  Messages are
+        made only as the link gives credit, so a full replay never
+        holds the encoded model.  Live updates follow the replay.
+        """
+
+        address_tree = SubscriptionTree()
+        address_tree.add(address, sender)
+
+        updates = self.server.app.model.updates_since(since_revision)
+
+        _log.info("Replaying up to %s updates since revision %s for '%s'", len(updates), since_revision, address)
+
+        self.replays[sender] = (x for x in updates if any(address_tree.match(x[0].event_path)))
+
+        self.drain(sender)
+
+def _update_message(obj, revision):
+    message = _proton.Message()
+    message.content_type = "application/json"
+    message.inferred = True
+    message.properties = {
+        "type": obj.type_name,
+        "path": obj.event_path,
+        "revision": revision,
+    }
+    message.body = obj.json()
+
+    return message
+
+_since_revision_filter = _proton.symbol("since-revision")
+
+def _since_revision(link):
+    filters = link.remote_source.filter
+    filters.rewind()
+
+    if filters.next() is None:
+        return None
+
+    value = filters.get_object().get(_since_revision_filter)
+
+    if isinstance(value, _proton.Described):
+        value = value.value
+
+    if isinstance(value, int):
+        return value
+
+def _links(connection):
+    link = connection.link_head(0)
+
+    while link is not None:
+        yield link
+        link = link.next(0)
+
+class OutboundQueue:
+    """
+    Messages waiting for credit on one subscriber link, bounded by
+    limit.
+
+    With the "keep-latest" policy, a new message for an event path
+    replaces any queued message for the same path, since it carries
+    the latest state.  With "drop-oldest", every message is queued.
+    In both cases the oldest message is dropped when the queue is
+    full.
+    """
+
+    def __init__(self, limit, policy="keep-latest"):
+        if policy not in ("keep-latest", "drop-oldest"):
+            raise ValueError(f"Unknown overflow policy: {policy}")
+
+        self.limit = limit
+        self.policy = policy
+        self.messages = _collections.OrderedDict()
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def push(self, path, message, bounded=True):
+        if self.policy == "keep-latest":
+            key = path
+            self.messages.pop(key, None)
+        else:
+            key = self.counter
+            self.counter += 1
+
+        self.messages[key] = message
+
+        if bounded and len(self.messages) > self.limit:
+            self.messages.popitem(last=False)
+            _log.warning("Dropped an update for a slow subscriber")
+
+    def pop(self):
+        return self.messages.popitem(last=False)[1]
+
+class SubscriptionTree:
+    """
+    Subscriber links indexed by address segment.  An address matches
+    event paths exactly, except that a "*" segment matches any one
+    segment and a final "#" segment matches zero or more segments.
+    The plain "events" address is the same as "events/#".
+
+    Matching an event path costs its depth, not the number of links.
+    """
+
+    def __init__(self):
+        self.root = _SubscriptionNode()
+
+    def add(self, address, link):
+        segments, wildcard = self._parse(address)
+        node = self.root
+
+        for segment in segments:
+            node = node.children.setdefault(segment, _SubscriptionNode())
+
+        if wildcard:
+            node.descendant_links.add(link)
+        else:
+            node.links.add(link)
+
+    def remove(self, address, link):
+        segments, wildcard = self._parse(address)
+        nodes = [self.root]
+
+        for segment in segments:
+            node = nodes[-1].children.get(segment)
+
+            if node is None:
+                return
+
+            nodes.append(node)
+
+        if wildcard:
+            nodes[-1].descendant_links.discard(link)
+        else:
+            nodes[-1].links.discard(link)
+
+        for segment, node, parent in reversed(list(zip(segments, nodes[1:], nodes))):
+            if node.links or node.descendant_links or node.children:
+                break
+
+            del parent.children[segment]
+
+    def match(self, path):
+        nodes = [self.root]
+
+        for segment in path.split("/"):
+            next_nodes = list()
+
+            for node in nodes:
+                yield from node.descendant_links
+
+                for key in (segment, "*"):
+                    child = node.children.get(key)
+
+                    if child is not None:
+                        next_nodes.append(child)
+
+            nodes = next_nodes
+
+        for node in nodes:
+            yield from node.links
+            yield from node.descendant_links
+
+    def _parse(self, address):
+        if address == "events":
+            address = "events/#"
+
+        segments = address.split("/")
+
+        if segments[-1] == "#":
+            return segments[:-1], True
+
+        return segments, False
+
+class _SubscriptionNode:
+    __slots__ = ("children", "links", "descendant_links")
+
+    def __init__(self):
+        self.children = dict()
+        self.links = set()
+        self.descendant_links = set()
@@ -22,12 +22,16 @@ import os as _os
 import threading as _threading
 import time as _time
 
+from . import jsonlib as _jsonlib
 from .amqpserver import AmqpServer
 from .httpserver import HttpServer
 from .model import Model
 
+_log = _logging.getLogger("app")
+
 class Application:
-    def __init__(self, home, data_dir=None, http_port=8080, amqp_port=5672, http_url=None, amqp_url=None):
+    def __init__(self, home, data_dir=None, http_port=8080, amqp_port=5672, http_url=None, amqp_url=None,
+                 tag_history_limit=10, compressed_cache_size=32 * 1024 * 1024, json_library=None):
         self.home = home
         self.data_dir = data_dir
         self.http_port = http_port
@@ -41,7 +45,11 @@ class Application:
 
         data_file = _os.path.join(self.data_dir, "data.json")
 
+        _jsonlib.use(json_library)
+
         self.model = Model(self, data_file)
+        self.model.tag_history_limit = tag_history_limit
+        self.model.compressed_cache.budget = compressed_cache_size
         self.http_server = HttpServer(self, port=self.http_port)
         self.amqp_server = AmqpServer(self, port=self.amqp_port)
 
@@ -51,6 +59,8 @@ class Application:
         if not _os.path.exists(self.data_dir):
             _os.makedirs(self.data_dir)
 
+        _log.info("Using JSON library %s", _jsonlib.library)
+
         self.model.load()
         self.model.start()
 
@@ -17,27 +17,63 @@
 # under the License.
 #
 
-import json.decoder as _json_decoder
+import asyncio as _asyncio
+import concurrent.futures as _futures
 import logging as _logging
 import os as _os
+import threading as _threading
 import uuid as _uuid
 
 from brbn import *
-from .model import BadDataError
+from . import jsonlib as _jsonlib
+from .amqpserver import OutboundQueue, SubscriptionTree
+from .model import BadDataError, compressed_encodings
 
 _log = _logging.getLogger("httpserver")
 
 class HttpServer(Server):
-    def __init__(self, app, host="", port=8080):
+    def __init__(self, app, host="", port=8080, watch_queue_limit=1000, watch_keepalive=30):
         super().__init__(app, host=host, port=port)
 
+        # Model changes run one at a time on a single writer thread,
+        # so waiting on the model lock or on the save thread never
+        # blocks the event loop serving reads
+
+        self.write_executor = _futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-writer")
+
+        # The whole-model body is built and compressed off the event
+        # loop.  A single thread means concurrent requests for a new
+        # revision wait for one build and then share the cached body.
+
+        self.data_executor = _futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-data")
+
+        # Watchers are indexed by address like AMQP subscribers.  An
+        # idle watcher is a tree entry and a waiting coroutine, so
+        # updates cost the depth of the event path, not the number of
+        # watchers.
+
+        self.watchers = SubscriptionTree()
+        self.watch_queue_limit = watch_queue_limit
+        self.watch_keepalive = watch_keepalive
+
+        self._loop = None
+        self._pending_updates = dict()
+        self._pending_updates_lock = _threading.Lock()
+
         self.add_route("/healthz", endpoint=Handler(), methods=["GET"])
         self.add_route("/api/data", endpoint=DataHandler(), methods=["GET", "HEAD"])
+        self.add_route("/api/batch", endpoint=BatchHandler(), methods=["POST"])
+        self.add_route("/api/tags", endpoint=TagListHandler(), methods=["GET", "HEAD"])
+        self.add_route("/api/artifacts", endpoint=ArtifactQueryHandler(), methods=["GET", "HEAD"])
+        self.add_route("/api/commits/{commit_id}", endpoint=CommitHandler(), methods=["GET", "HEAD"])
+        self.add_route("/api/watch/{path:path}", endpoint=WatchHandler(), methods=["GET"])
         self.add_route("/api/repos/{repo_id}", endpoint=RepoHandler(), methods=["PUT", "DELETE", "GET", "HEAD"])
         self.add_route("/api/repos/{repo_id}/branches/{branch_id}",
                        endpoint=BranchHandler(), methods=["PUT", "DELETE", "GET", "HEAD"])
         self.add_route("/api/repos/{repo_id}/branches/{branch_id}/tags/{tag_id}",
                        endpoint=TagHandler(), methods=["PUT", "DELETE", "GET", "HEAD"])
+        self.add_route("/api/repos/{repo_id}/branches/{branch_id}/tags/{tag_id}/history",
+                       endpoint=TagHistoryHandler(), methods=["GET", "HEAD"])
         self.add_route("/api/repos/{repo_id}/branches/{branch_id}/tags/{tag_id}/artifacts/{artifact_id}",
                        endpoint=ArtifactHandler(), methods=["PUT", "DELETE", "GET", "HEAD"])
         self.add_route("/", endpoint=HtmlHandler(), methods=["GET", "HEAD"])
@@ -47,10 +83,54 @@ class HttpServer(Server):
 
         self.add_static_files("", _os.path.join(app.home, "static"))
 
+    def fire_object_update(self, obj, revision):
+        if self._loop is None:
+            return
+
+        with self._pending_updates_lock:
+            first = not self._pending_updates
+
+            self._pending_updates.pop(obj.event_path, None)
+            self._pending_updates[obj.event_path] = (obj, revision)
+
+        if first:
+            self._loop.call_soon_threadsafe(self._send_updates)
+
+    def _send_updates(self):
+        with self._pending_updates_lock:
+            updates = self._pending_updates
+            self._pending_updates = dict()
+
+        for obj, revision in updates.values():
+            for watcher in self.watchers.match(obj.event_path):
+                watcher.push(obj, revision)
+
+    def add_watcher(self, address, queued=True):
+        self._loop = _asyncio.get_running_loop()
+
+        watcher = _Watcher(self.watch_queue_limit if queued else None)
+        self.watchers.add(address, watcher)
+
+        return watcher
+
+    def remove_watcher(self, address, watcher):
+        self.watchers.remove(address, watcher)
+
 class BadDataResponse(PlainTextResponse):
     def __init__(self, exception):
         super().__init__(f"Bad request: Illegal data: {exception}\n", 400)
 
+class EncodedJsonResponse(Response):
+    media_type = "application/json"
+
+    def __init__(self, content, encoding=None):
+        headers = {"Vary": "Accept-Encoding"}
+
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+
+        super().__init__(content, headers=headers)
+
 class ModelObjectHandler(Handler):
     async def handle(self, request):
         try:
@@ -60,29 +140,390 @@ class ModelObjectHandler(Handler):
         except BadDataError as e:
             return BadDataResponse(e)
 
+    async def write(self, request, function, *args):
+        loop = _asyncio.get_running_loop()
+        return await loop.run_in_executor(request.app.http_server.write_executor, function, *args)
+
     def etag(self, request, obj):
         if obj is not None:
-            return str(obj._digest)
+            return str(obj.digest())
 
     async def render(self, request, obj):
-        if request.method in ("PUT", "DELETE"):
+        if request.method in ("PUT", "DELETE", "POST"):
             return OkResponse()
 
         assert obj is not None
 
-        accept_encoding = request.headers.get("Accept-Encoding")
+        encoding = _select_encoding(request.headers.get("Accept-Encoding"))
+
+        if encoding is not None:
+            return EncodedJsonResponse(obj.compressed_data(encoding), encoding)
+
+        # The model keeps each object's JSON bytes, so they are sent
+        # as they are instead of being serialized again
+
+        return EncodedJsonResponse(obj.json())
+
+def _select_encoding(accept_encoding):
+    """
+    Return the supported encoding with the highest q-value in an
+    Accept-Encoding header, using our preference to break ties, or
+    None if the body should not be encoded.
+    """
+
+    if accept_encoding is None:
+        return None
+
+    qvalues = dict()
+
+    for item in accept_encoding.split(","):
+        coding, *params = item.split(";")
+        qvalue = 1.0
+
+        for param in params:
+            name, _, value = param.partition("=")
+
+            if name.strip().lower() == "q":
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+
+        qvalues[coding.strip().lower()] = qvalue
+
+    selected, selected_qvalue = None, 0.0
+
+    for encoding in compressed_encodings:
+        qvalue = qvalues.get(encoding, qvalues.get("*", 0.0))
+
+        if qvalue > selected_qvalue:
+            selected, selected_qvalue = encoding, qvalue
+
+    # Identity counts only if the client lists it explicitly
+
+    if qvalues.get("identity", 0.0) > selected_qvalue:
+        return None
 
-        if accept_encoding is not None and "gzip" in accept_encoding and obj._compressed_data is not None:
-            return CompressedJsonResponse(obj._compressed_data)
-        else:
-            return JsonResponse(obj.data())
+    return selected
+
+class GoneResponse(PlainTextResponse):
+    def __init__(self, message):
+        super().__init__(f"Gone: {message}\n", 410)
 
 class DataHandler(ModelObjectHandler):
+    """
+    With "Accept: text/event-stream", stream a "delta" event, in the
+    format of GET /api/data?since=<revision>, for each change after
+    the since query parameter or Last-Event-ID header.  Without
+    either, or if a client falls too far behind, it gets a "reset"
+    event and the stream ends.  The client then fetches the full
+    data, compressed, and starts again from its revision.
+    """
+
+    async def handle(self, request):
+        if "text/event-stream" in request.headers.get("Accept", ""):
+            return self.stream(request)
+
+        return await super().handle(request)
+
+    def stream(self, request):
+        server = request.app.http_server
+        model = request.app.model
+        since = request.headers.get("Last-Event-ID", request.query_params.get("since"))
+
+        try:
+            since = int(since) if since is not None else None
+        except ValueError:
+            raise BadRequestError(f"Illegal revision: {since}")
+
+        async def events():
+            watcher = server.add_watcher("events", queued=False)
+            revision = since
+
+            try:
+                while True:
+                    watcher.event.clear()
+
+                    if model.revision != revision:
+                        delta = model.delta_json(revision) if revision is not None else None
+
+                        if delta is None:
+                            yield _event(None, "reset", b"{}")
+                            return
+
+                        revision, data = delta
+                        yield _event(revision, "delta", data)
+
+                    try:
+                        await _asyncio.wait_for(watcher.event.wait(), server.watch_keepalive)
+                    except _asyncio.TimeoutError:
+                        yield b": keepalive\n\n"
+            finally:
+                server.remove_watcher("events", watcher)
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
     async def process(self, request):
-        return request.app.model
+        model = request.app.model
+        since = request.query_params.get("since")
+
+        if since is None:
+            return model
+
+        try:
+            since = int(since)
+        except ValueError:
+            raise BadRequestError(f"Illegal revision: {since}")
+
+        delta = model.delta_json(since)
+
+        if delta is None:
+            raise HandlingException("Revision unavailable",
+                                    GoneResponse(f"Changes since revision {since} are not available"))
+
+        return delta
+
+    def etag(self, request, entity):
+        if isinstance(entity, tuple):
+            return str(entity[0])
+
+        return str(request.app.model.revision)
+
+    async def render(self, request, entity):
+        if isinstance(entity, tuple):
+            return EncodedJsonResponse(entity[1])
+
+        loop = _asyncio.get_running_loop()
+        executor = request.app.http_server.data_executor
+        encoding = _select_encoding(request.headers.get("Accept-Encoding"))
+
+        if encoding is not None:
+            return EncodedJsonResponse(await loop.run_in_executor(executor, entity.compressed_data, encoding), encoding)
+
+        return EncodedJsonResponse(await loop.run_in_executor(executor, entity.json))
+
+class QueryHandler(ModelObjectHandler):
+    """
+    Serves the JSON bytes of a model query.  The results change only
+    with the model revision.
+    """
+
+    def etag(self, request, entity):
+        return str(request.app.model.revision)
+
+    async def render(self, request, entity):
+        return EncodedJsonResponse(entity)
+
+class TagListHandler(QueryHandler):
+    _sort_orders = {"update_time": False, "-update_time": True}
+
+    async def process(self, request):
+        model = request.app.model
+        sort = request.query_params.get("sort", "-update_time")
+
+        try:
+            reverse = self._sort_orders[sort]
+        except KeyError:
+            raise BadRequestError(f"Unknown sort: {sort}")
+
+        try:
+            limit = int(request.query_params.get("limit", 100))
+        except ValueError:
+            raise BadRequestError("Illegal limit")
+
+        if limit < 1 or limit > 1000:
+            raise BadRequestError("Limit must be between 1 and 1000")
+
+        try:
+            return model.tags_json(limit, request.query_params.get("cursor"), reverse)
+        except ValueError as e:
+            raise BadRequestError(str(e))
+
+class ArtifactQueryHandler(QueryHandler):
+    async def process(self, request):
+        model = request.app.model
+        type = request.query_params.get("type")
+
+        try:
+            return model.artifacts_json(type, request.query_params)
+        except ValueError as e:
+            raise BadRequestError(str(e))
+
+class CommitHandler(QueryHandler):
+    async def process(self, request):
+        commit_id = request.path_params["commit_id"]
+        commit = request.app.model.commit_json(commit_id)
+
+        if commit is None:
+            raise KeyError(commit_id)
+
+        return commit
+
+class TagHistoryHandler(QueryHandler):
+    async def process(self, request):
+        repo_id = request.path_params["repo_id"]
+        branch_id = request.path_params["branch_id"]
+        tag_id = request.path_params["tag_id"]
+        limit = request.query_params.get("limit")
+
+        try:
+            limit = int(limit) if limit is not None else None
+        except ValueError:
+            raise BadRequestError("Illegal limit")
+
+        if limit is not None and limit < 0:
+            raise BadRequestError("Limit must not be negative")
+
+        history = request.app.model.tag_history_json(repo_id, branch_id, tag_id, limit)
+
+        if history is None:
+            raise KeyError(tag_id)
+
+        return history
+
+class BatchHandler(ModelObjectHandler):
+    async def process(self, request):
+        model = request.app.model
+        batch_data = await _read_json(request)
+
+        if not isinstance(batch_data, list) or not all(isinstance(x, dict) for x in batch_data):
+            raise BadDataError("Batch data must be a list of operations")
+
+        operations = [(x.get("op"), x.get("path"), x.get("data")) for x in batch_data]
+
+        if request.query_params.get("dry-run") == "1":
+            return
+
+        await self.write(request, model.apply, operations)
+
+class WatchHandler(ModelObjectHandler):
+    """
+    With "Accept: text/event-stream", stream server-sent events for
+    the objects under an address, which takes the same wildcards as
+    AMQP addresses.  A Last-Event-ID header replays the updates since
+    that revision.
+
+    Otherwise, long-poll one object: if the If-None-Match header holds
+    the object's current ETag, wait up to timeout seconds for it to
+    change before responding as a GET would.
+    """
+
+    async def handle(self, request):
+        address = f"events/{request.path_params['path']}"
+
+        if "text/event-stream" in request.headers.get("Accept", ""):
+            return self.stream(request, address)
+
+        return await super().handle(request)
+
+    async def process(self, request):
+        server = request.app.http_server
+        address = f"events/{request.path_params['path']}"
+
+        try:
+            timeout = float(request.query_params.get("timeout", 30))
+        except ValueError:
+            raise BadRequestError("Illegal timeout")
+
+        watcher = server.add_watcher(address)
+
+        try:
+            obj = _find_object(request.app.model, address)
+            client_etag = request.headers.get("if-none-match")
+
+            if obj is not None and client_etag == f'"{obj.digest()}"':
+                try:
+                    await _asyncio.wait_for(watcher.event.wait(), timeout)
+                except _asyncio.TimeoutError:
+                    pass
+
+                obj = _find_object(request.app.model, address)
+        finally:
+            server.remove_watcher(address, watcher)
+
+        if obj is None:
+            raise KeyError(address)
+
+        return obj
+
+    def stream(self, request, address):
+        server = request.app.http_server
+
+        try:
+            since_revision = int(request.headers["Last-Event-ID"])
+        except (KeyError, ValueError):
+            since_revision = None
+
+        async def events():
+            watcher = server.add_watcher(address)
+
+            try:
+                if since_revision is not None:
+                    address_tree = SubscriptionTree()
+                    address_tree.add(address, watcher)
+
+                    for obj, revision in request.app.model.updates_since(since_revision):
+                        if any(address_tree.match(obj.event_path)):
+                            watcher.push(obj, revision, bounded=False)
+
+                while True:
+                    while watcher.updates:
+                        yield _update_event(*watcher.updates.pop())
+
+                    try:
+                        await _asyncio.wait_for(watcher.event.wait(), server.watch_keepalive)
+                    except _asyncio.TimeoutError:
+                        yield b": keepalive\n\n"
+
+                    watcher.event.clear()
+            finally:
+                server.remove_watcher(address, watcher)
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+class _Watcher:
+    """
+    Updates waiting for one watcher.  With a queue_limit of None,
+    the watcher keeps no updates and is only woken.
+    """
+
+    __slots__ = ("updates", "event")
+
+    def __init__(self, queue_limit):
+        self.updates = OutboundQueue(queue_limit) if queue_limit is not None else None
+        self.event = _asyncio.Event()
+
+    def push(self, obj, revision, bounded=True):
+        if self.updates is not None:
+            self.updates.push(obj.event_path, (obj, revision), bounded=bounded)
+
+        self.event.set()
+
+async def _read_json(request):
+    try:
+        return _jsonlib.loads(await request.body())
+    except ValueError as e:
+        raise BadDataError(f"Illegal JSON: {e}")
+
+def _find_object(model, address):
+    obj = model.find_object(address)
+
+    if obj is not None and obj.event_path == address:
+        return obj
+
+def _update_event(obj, revision):
+    fields = {"type": obj.type_name, "path": obj.event_path, "revision": revision}
+    data = _jsonlib.dumps(fields)[:-1] + b', "data": ' + obj.json() + b"}"
+
+    return _event(revision, "update", data)
+
+def _event(revision, name, data):
+    # An event without a revision has no ID, so it leaves the
+    # client's Last-Event-ID as it was
+
+    id = b"id: " + str(revision).encode("utf-8") + b"\n" if revision is not None else b""
 
-    def etag(self, request, model):
-        return str(model.revision)
+    return b"".join((id, b"event: ", name.encode("utf-8"), b"\ndata: ", data, b"\n\n"))
 
 class RepoHandler(ModelObjectHandler):
     async def process(self, request):
@@ -93,11 +534,11 @@ class RepoHandler(ModelObjectHandler):
             return
 
         if request.method == "PUT":
-            repo_data = await request.json()
-            return model.put_repo(repo_id, repo_data)
+            repo_data = await _read_json(request)
+            return await self.write(request, model.put_repo, repo_id, repo_data)
 
         if request.method == "DELETE":
-            return model.delete_repo(repo_id)
+            return await self.write(request, model.delete_repo, repo_id)
 
         return model.repos[repo_id]
 
@@ -111,11 +552,11 @@ class BranchHandler(ModelObjectHandler):
             return
 
         if request.method == "PUT":
-            branch_data = await request.json()
-            return model.put_branch(repo_id, branch_id, branch_data)
+            branch_data = await _read_json(request)
+            return await self.write(request, model.put_branch, repo_id, branch_id, branch_data)
 
         if request.method == "DELETE":
-            return model.delete_branch(repo_id, branch_id)
+            return await self.write(request, model.delete_branch, repo_id, branch_id)
 
         return model.repos[repo_id].branches[branch_id]
 
@@ -130,11 +571,11 @@ class TagHandler(ModelObjectHandler):
             return
 
         if request.method == "PUT":
-            tag_data = await request.json()
-            return model.put_tag(repo_id, branch_id, tag_id, tag_data)
+            tag_data = await _read_json(request)
+            return await self.write(request, model.put_tag, repo_id, branch_id, tag_id, tag_data)
 
         if request.method == "DELETE":
-            return model.delete_tag(repo_id, branch_id, tag_id)
+            return await self.write(request, model.delete_tag, repo_id, branch_id, tag_id)
 
         return model.repos[repo_id].branches[branch_id].tags[tag_id]
 
@@ -150,11 +591,11 @@ class ArtifactHandler(ModelObjectHandler):
             return
 
         if request.method == "PUT":
-            artifact_data = await request.json()
-            return model.put_artifact(repo_id, branch_id, tag_id, artifact_id, artifact_data)
+            artifact_data = await _read_json(request)
+            return await self.write(request, model.put_artifact, repo_id, branch_id, tag_id, artifact_id, artifact_data)
 
         if request.method == "DELETE":
-            return model.delete_artifact(repo_id, branch_id, tag_id, artifact_id)
+            return await self.write(request, model.delete_artifact, repo_id, branch_id, tag_id, artifact_id)
 
         return model.repos[repo_id].branches[branch_id].tags[tag_id].artifacts[artifact_id]
 
@@ -0,0 +1,104 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+# JSON encoding and decoding through the fastest library available.
+# dumps() returns UTF-8 bytes, and loads() accepts bytes or str.
+# Decoding errors are raised as ValueError whichever library is in
+# use.
+#
+# Callers look the functions up here at the time of the call, as in
+# jsonlib.dumps(x), so that use() takes effect everywhere.
+
+import json as _json
+import logging as _logging
+
+_log = _logging.getLogger("jsonlib")
+
+def _load_orjson():
+    import orjson
+
+    return orjson.dumps, orjson.loads
+
+def _load_ujson():
+    import ujson
+
+    def dumps(value):
+        return ujson.dumps(value, escape_forward_slashes=False).encode("utf-8")
+
+    return dumps, ujson.loads
+
+def _load_json():
+    def dumps(value):
+        return _json.dumps(value).encode("utf-8")
+
+    return dumps, _json.loads
+
+_libraries = {
+    "orjson": _load_orjson,
+    "ujson": _load_ujson,
+    "json": _load_json,
+}
+
+library_names = list(_libraries)
+
+library = None
+dumps = None
+loads = None
+
+def use(name=None):
+    """
+    Use the named library, or the first available one in the order
+    of library_names if name is None.  Raises ImportError if the
+    named library is not installed.
+    """
+
+    global library, dumps, loads
+
+    if name is not None and name not in _libraries:
+        raise ValueError(f"Unknown JSON library: {name}")
+
+    for candidate in [name] if name is not None else library_names:
+        try:
+            dumps, loads = _libraries[candidate]()
+        except ImportError:
+            if name is not None:
+                raise
+
+            continue
+
+        library = candidate
+
+        _log.debug("Using JSON library %s", library)
+
+        return library
+
+def available_libraries():
+    names = list()
+
+    for name in library_names:
+        try:
+            _libraries[name]()
+        except ImportError:
+            continue
+
+        names.append(name)
+
+    return names
+
+use()
@@ -17,37 +17,111 @@
 # under the License.
 #
 
+import base64 as _base64
 import binascii as _binascii
+import bisect as _bisect
+import collections as _collections
 import gzip as _gzip
-import json as _json
 import logging as _logging
 import os as _os
+import sys as _sys
 import threading as _threading
 import time as _time
 import traceback as _traceback
 
+from . import jsonlib as _jsonlib
+
+try:
+    import brotli as _brotli
+except ImportError:
+    _brotli = None
+
+try:
+    import zstandard as _zstandard
+except ImportError:
+    _zstandard = None
+
 _log = _logging.getLogger("model")
 
 class Model:
     def __init__(self, app, data_file):
         self.app = app
         self.data_file = data_file
+        self.journal_file = f"{_os.path.splitext(data_file)[0]}.journal"
+        self.events_file = f"{_os.path.splitext(data_file)[0]}.events"
+        self.history_file = f"{_os.path.splitext(data_file)[0]}.history"
+        self.min_compaction_size = 1024 * 1024
+        self.change_limit = 10000
+        self.tag_history_limit = 10
 
         self.repos = dict()
         self.revision = 0
 
-        self._compressed_data = None
+        # The whole-model computed values are checked against the
+        # cache version rather than the revision.  A rollback changes
+        # the cache version but not the revision.
+
+        self._json = None
+        self._cache_version = 0
+
+        # Compressed bodies are only worth keeping for objects that
+        # are fetched often, so they share one cache with a budget of
+        # bytes.  Each is stored with the version it was made from.
+
+        self.compressed_cache = CompressedCache(32 * 1024 * 1024)
+
+        self._journal_records = list()
+        self._journal_size = 0
+        self._undo = None
+        self._snapshot_size = 0
+
+        # For each recent revision, oldest first, the event paths of
+        # every object that changed and the puts and deletes that
+        # changed them.  They are kept on disk in the events file as
+        # well.
+
+        self._changes = _collections.deque(maxlen=self.change_limit)
+        self._change_records = list()
+
+        # Secondary indexes, kept current by _set(), _delete(), and
+        # _rollback() through _index() and _unindex().  Like the tag
+        # history below, they are changed and read only under the
+        # cache lock, which is held briefly.  Queries on the event
+        # loop never wait for a whole change or a save.
+
+        self._tags_by_update_time = SortedIndex()
+        self._artifacts_by_coordinates = MultiIndex()
+        self._tags_by_commit = MultiIndex()
+
+        # The previous versions of each tag by (repo, branch, tag) ID,
+        # in a TagHistory holding up to tag_history_limit versions.
+        # Like the changes, they are kept on disk in the history file,
+        # as whole versions.
+
+        self._tag_history = dict()
+        self._history_records = list()
 
         self._lock = _threading.Lock()
+        self._cache_lock = _threading.Lock()
         self._modified = _threading.Event()
         self._save_thread = SaveThread(self)
 
     def load(self):
-        if not _os.path.exists(self.data_file):
-            return
+        if _os.path.exists(self.data_file):
+            self._load_snapshot()
+
+        if _os.path.exists(self.journal_file):
+            self._load_journal()
 
-        with open(self.data_file, "r") as f:
-            data = _json.load(f)
+        if _os.path.exists(self.events_file):
+            self._load_events()
+
+        if _os.path.exists(self.history_file):
+            self._load_history()
+
+    def _load_snapshot(self):
+        with open(self.data_file, "rb") as f:
+            data = _jsonlib.loads(f.read())
 
             assert "repos" in data, "No repos field in data"
             assert "revision" in data, "No revision field in data"
@@ -55,171 +129,907 @@ class Model:
             for repo_id, repo_data in data["repos"].items():
                 repo = Repo(self, repo_id, None, **repo_data)
                 self.repos[repo_id] = repo
+                self._index(repo)
 
             self.revision = data["revision"]
 
-        self._save_computed_values()
+        self._snapshot_size = _os.path.getsize(self.data_file)
+
+    def _load_journal(self):
+        # Replay the changes recorded since the last snapshot.  Each
+        # record holds every operation of one change, so a record cut
+        # short by a crash drops the whole change.  It ends the
+        # journal, and the journal is truncated there so later records
+        # are not appended to it.
+
+        snapshot_revision = self.revision
+        size = 0
+        count = 0
+
+        with open(self.journal_file, "rb") as f:
+            for line in f:
+                try:
+                    record = _jsonlib.loads(line)
+                except ValueError:
+                    _log.warning("Truncating journal at a bad record (offset %s)", size)
+                    break
+
+                if record["revision"] > snapshot_revision:
+                    self._replay(record)
+                    self.revision = record["revision"]
+                    count += 1
+
+                size += len(line)
+
+        if size < _os.path.getsize(self.journal_file):
+            _os.truncate(self.journal_file, size)
+
+        self._journal_size = size
+
+        _log.info("Replayed %s journal records", count)
+
+    def _load_events(self):
+        # Changes are only useful if they run up to the current
+        # revision without a gap.  Keep that run and drop the rest,
+        # including a torn record and any records past the current
+        # revision.  If anything is dropped, the file is rewritten so
+        # later records are appended to the run kept here.
+
+        count = 0
+
+        with open(self.events_file, "rb") as f:
+            for line in f:
+                count += 1
+
+                try:
+                    record = _jsonlib.loads(line)
+                except ValueError:
+                    break
+
+                revision = record["revision"]
+
+                if revision > self.revision:
+                    continue
+
+                if self._changes and revision != self._changes[-1][0] + 1:
+                    self._changes.clear()
+
+                self._changes.append((revision, record["paths"], record.get("changes", [])))
+
+        if self._changes and self._changes[-1][0] != self.revision:
+            self._changes.clear()
+
+        if len(self._changes) != count:
+            _log.info("Rewriting events file with %s changes", len(self._changes))
+            self._save_records(self.events_file, [self._change_record(*x) for x in self._changes])
+
+    def _load_history(self):
+        with open(self.history_file, "rb") as f:
+            for line in f:
+                try:
+                    record = _jsonlib.loads(line)
+                except ValueError:
+                    break
+
+                if record["revision"] <= self.revision:
+                    data = record["data"]
+                    version = _tag_version_of_data(data) if data is not None else None
+
+                    self._update_tag_history(tuple(record["path"]), record["revision"], version)
 
     def start(self):
         self._save_thread.start()
 
-    def mark_modified(self):
-        self.revision += 1
-        self._save_computed_values()
+        # Objects are loaded without their computed values.  Build
+        # the snapshot in the background, in each encoding a client
+        # may prefer, so the first request for it doesn't stall.
+
+        warm_thread = _threading.Thread(target=self._warm_compressed_data, daemon=True)
+        warm_thread.start()
+
+    def _warm_compressed_data(self):
+        for encoding in compressed_encodings:
+            self.compressed_data(encoding)
+
+    def mark_modified(self, change=None):
+        # The whole-model JSON is rebuilt from the cached JSON of each
+        # repo on the next request for it.  Only the repo that changed
+        # needs to be serialized again.
+        #
+        # The change that made the new revision is published with it,
+        # so readers of the change log never see one without the
+        # other.
+
+        with self._cache_lock:
+            self.revision += 1
+            self._cache_version += 1
+            self._json = None
+
+            if change is not None:
+                self._changes.append(change)
+
+        self.compressed_cache.discard_all(self)
         self._modified.set()
 
-    def _save_computed_values(self):
-        self._compressed_data = _gzip.compress(self.json().encode("utf-8"))
+    def compressed_data(self, encoding="gzip"):
+        return self.compressed_cache.compute((self, encoding), self._cache_version,
+                                             lambda: _compress(self.json(), encoding, True))
+
+    def _computed_value(self, name, compute):
+        value = getattr(self, name)
+
+        if value is None:
+            version = self._cache_version
+            value = compute()
+
+            with self._cache_lock:
+                if self._cache_version == version:
+                    setattr(self, name, value)
+
+        return value
 
     def save(self):
+        # Operations are appended to the journal.  Once the journal
+        # grows larger than the last snapshot, a new snapshot is
+        # written and the journal starts over.
+        #
+        # Only the pending records and the snapshot bytes are taken
+        # under the lock.  The snapshot JSON is assembled from cached
+        # per-object JSON and never changes once built, so the disk
+        # writes happen outside the lock.
+
         with self._lock:
-            temp = f"{self.data_file}.temp"
-            data = self.data()
+            records = self._journal_records
+            self._journal_records = list()
+
+            change_records = self._change_records
+            self._change_records = list()
+
+            snapshot = None
+            journal_size = self._journal_size + sum(len(x) for x in records)
+
+            history_records = self._history_records
+            self._history_records = list()
+
+            if journal_size > max(self._snapshot_size, self.min_compaction_size):
+                snapshot = self.json()
+                changes = list(self._changes)
+                history = [(key, list(x.entries)) for key, x in self._tag_history.items()]
+
+        # The snapshot covers every pending record, so they go to the
+        # journal only when there is no snapshot to write.  The events
+        # and history files are rewritten at the same time to drop old
+        # entries.
+        #
+        # If a write fails, the records it did not cover go back to
+        # the front of the pending lists for the next save to retry.
+
+        try:
+            if snapshot is not None:
+                self._save_snapshot(snapshot)
+            else:
+                self._journal_size = self._append_records(self.journal_file, records)
+
+            records = []
+
+            if snapshot is not None:
+                self._save_records(self.events_file, [self._change_record(*x) for x in changes])
+            else:
+                self._append_records(self.events_file, change_records)
+
+            change_records = []
+
+            if snapshot is not None:
+                self._save_records(self.history_file, [self._history_record(revision, key, data)
+                                                       for key, entries in history
+                                                       for revision, data in TagHistory.expand(entries)[::-1]])
+            else:
+                self._append_records(self.history_file, history_records)
+
+            history_records = []
+        except:
+            with self._lock:
+                self._journal_records[:0] = records
+                self._change_records[:0] = change_records
+                self._history_records[:0] = history_records
+
+            raise
+
+    def _save_snapshot(self, snapshot):
+        temp = f"{self.data_file}.temp"
+
+        with open(temp, "wb") as f:
+            f.write(snapshot)
+            f.flush()
+            _os.fsync(f.fileno())
+
+        _os.rename(temp, self.data_file)
+
+        with open(self.journal_file, "wb"):
+            pass
+
+        self._snapshot_size = len(snapshot)
+        self._journal_size = 0
+
+    def _save_records(self, file, records):
+        temp = f"{file}.temp"
+
+        with open(temp, "wb") as f:
+            f.writelines(records)
+            f.flush()
+            _os.fsync(f.fileno())
+
+        _os.rename(temp, file)
+
+    def _append_records(self, file, records):
+        # The file is unbuffered, so a failed write can be cut off
+        # without leaving buffered bytes to land after the cut.  Later
+        # records then never follow a torn one.  Returns the new size.
+
+        data = memoryview(b"".join(records))
+
+        with open(file, "ab", buffering=0) as f:
+            start = f.seek(0, _os.SEEK_END)
+
+            try:
+                while data:
+                    data = data[f.write(data):]
+
+                _os.fsync(f.fileno())
+            except:
+                f.truncate(start)
+                raise
+
+            return f.tell()
+
+    def changes_since(self, revision):
+        """
+        Return the event paths changed after revision, each with the
+        last revision that changed it, in revision order.  Returns
+        None if the changes since revision are no longer known.
+        """
+
+        changes = self._changes_after(revision)
+
+        if changes is None:
+            return None
+
+        paths = dict()
+
+        for change_revision, change_paths, _ in changes:
+            for path in change_paths:
+                paths.pop(path, None)
+                paths[path] = change_revision
+
+        return paths
+
+    def updates_since(self, revision):
+        """
+        Return (object, revision) pairs for the objects changed after
+        revision, or for every object if those changes are no longer
+        known.  Deleted objects are left out.
+        """
+
+        changes = self.changes_since(revision)
+
+        if changes is None:
+            current_revision = self.revision
+            return [(obj, current_revision) for obj in self.objects()]
+
+        updates = [(self.find_object(path), revision) for path, revision in changes.items()]
+
+        return [x for x in updates if x[0] is not None]
+
+    def delta_json(self, revision):
+        """
+        Return (revision, JSON) for the puts and deletes that bring a
+        copy of the model at revision up to date, or None if the
+        changes since revision are no longer known.  The returned
+        revision is that of the last change included.  Each put
+        carries the current data of its object.
+        """
+
+        changes = self._changes_after(revision)
+
+        if changes is None:
+            return None
 
-            with open(temp, "w") as f:
-                _json.dump(data, f)
+        current_revision = changes[-1][0] if changes else revision
 
-            _os.rename(temp, self.data_file)
+        # Collapse the changes so each path appears once.  A put or
+        # delete supersedes any earlier change at or under its path,
+        # so walking newest first, a change is kept only if neither
+        # its path nor one of its ancestors was kept already.  Paths
+        # are at most four levels deep, so this is linear in the
+        # number of changes.
+
+        kinds = dict()
+
+        for _, _, change_list in reversed(changes):
+            for kind, path in reversed(change_list):
+                if path in kinds or any(x in kinds for x in _ancestor_paths(path)):
+                    continue
+
+                kinds[path] = kind
+
+        operations = list()
+
+        for path, kind in reversed(kinds.items()):
+            ids = path.split("/")[2::2]
+
+            # The data of a parent put includes its children
+
+            if any(kinds.get(x) == "put" for x in _ancestor_paths(path)):
+                continue
+
+            op = f"{kind}_{_type_names[len(ids) - 1]}"
+            operation = _jsonlib.dumps({"op": op, "path": ids})
+
+            if kind == "put":
+                obj = self.find_object(path)
+
+                if obj is None:
+                    continue
+
+                operation = operation[:-1] + b', "data": ' + obj.json() + b"}"
+
+            operations.append(operation)
+
+        return current_revision, b"".join((
+            b'{"revision": ', str(current_revision).encode("utf-8"),
+            b', "since": ', str(revision).encode("utf-8"),
+            b', "operations": [', b", ".join(operations), b"]}",
+        ))
+
+    def _changes_after(self, revision):
+        with self._cache_lock:
+            changes = list(self._changes)
+            current_revision = self.revision
+
+        if changes:
+            oldest_revision = changes[0][0] - 1
+        else:
+            oldest_revision = current_revision
+
+        if revision < oldest_revision or revision > current_revision:
+            return None
+
+        return [x for x in changes if x[0] > revision]
+
+    def _change_record(self, revision, paths, changes):
+        record = {
+            "revision": revision,
+            "paths": paths,
+            "changes": changes,
+        }
+
+        return _jsonlib.dumps(record) + b"\n"
+
+    def find_object(self, path):
+        """
+        Return the object at an API or event path, such as
+        "events/repos/a/branches/b", or None if there is none.
+        """
+
+        segments = path.split("/")
+        children = {"repos": self.repos}
+        obj = None
+
+        for collection_name, id in zip(segments[1::2], segments[2::2]):
+            try:
+                obj = children[collection_name][id]
+            except KeyError:
+                return None
+
+            children = {x: getattr(obj, x) for x in obj._child_fields}
+
+        return obj
+
+    def objects(self):
+        """
+        Generate every object in the model, parents before children.
+        """
+
+        for repo in list(self.repos.values()):
+            yield from repo.walk()
+
+    def tags_json(self, limit, cursor=None, reverse=False):
+        """
+        Return the JSON for a page of up to limit tags in update time
+        order, or newest first if reverse is set.  The page starts
+        after cursor, a value from the next_cursor field of the
+        previous page.  Raises ValueError for an illegal cursor.
+        """
+
+        after = _decode_cursor(cursor) if cursor is not None else None
+
+        with self._cache_lock:
+            revision = self.revision
+            entries = self._tags_by_update_time.page(limit + 1, after, reverse)
+
+        next_cursor = None
+
+        if len(entries) > limit:
+            entries = entries[:limit]
+            next_cursor = _encode_cursor(entries[-1][0])
+
+        tags = [_encode_entry(tag) for _, tag in entries]
+
+        return b"".join((
+            b'{"revision": ', str(revision).encode("utf-8"),
+            b', "tags": [', b", ".join(tags), b"]",
+            b', "next_cursor": ', _jsonlib.dumps(next_cursor), b"}",
+        ))
+
+    def artifacts_json(self, type, coordinates):
+        """
+        Return the JSON for the artifacts of a type with the given
+        coordinates, a mapping holding a value for each of the type's
+        coordinate fields.  Raises ValueError for an unknown type or a
+        missing coordinate.
+        """
+
+        try:
+            cls = Artifact._subclasses_by_type[type]
+        except KeyError:
+            raise ValueError(f"Unknown artifact type: {type}")
+
+        missing = [x for x in cls._coordinate_fields if x not in coordinates]
+
+        if missing:
+            raise ValueError(f"Missing artifact coordinates: {', '.join(missing)}")
+
+        key = (type, *[coordinates[x] for x in cls._coordinate_fields])
+
+        with self._cache_lock:
+            revision = self.revision
+            artifacts = self._artifacts_by_coordinates.get(key)
+
+        return b"".join((
+            b'{"revision": ', str(revision).encode("utf-8"),
+            b', "artifacts": [', b", ".join(_encode_entry(x) for x in artifacts), b"]}",
+        ))
+
+    def commit_json(self, commit_id):
+        """
+        Return the JSON for the tags built from a commit, or None if
+        there are none.
+        """
+
+        with self._cache_lock:
+            revision = self.revision
+            tags = self._tags_by_commit.get(commit_id)
+
+        if not tags:
+            return None
+
+        return b"".join((
+            b'{"revision": ', str(revision).encode("utf-8"),
+            b', "commit_id": ', _jsonlib.dumps(commit_id),
+            b', "tags": [', b", ".join(_encode_entry(x) for x in tags), b"]}",
+        ))
+
+    def tag_history_json(self, repo_id, branch_id, tag_id, limit=None):
+        """
+        Return the JSON for up to limit previous versions of a tag,
+        newest first, or None if there is no such tag.
+        """
+
+        key = (repo_id, branch_id, tag_id)
+
+        if self.find_object(f"events/repos/{repo_id}/branches/{branch_id}/tags/{tag_id}") is None:
+            return None
+
+        with self._cache_lock:
+            revision = self.revision
+            tag_history = self._tag_history.get(key)
+            entries = list(tag_history.entries) if tag_history is not None else []
+
+        history = [b'{"revision": ' + str(x).encode("utf-8") + b', "data": ' + data + b"}"
+                   for x, data in TagHistory.expand(entries, limit)]
+
+        return b"".join((
+            b'{"revision": ', str(revision).encode("utf-8"),
+            b', "path": ', _jsonlib.dumps(list(key)),
+            b', "history": [', b", ".join(history), b"]}",
+        ))
 
     def data(self):
         repos = dict()
 
-        for repo_id, repo in self.repos.items():
+        for repo_id, repo in list(self.repos.items()):
             assert isinstance(repo, Repo), repo
             repos[repo_id] = repo.data()
 
         return {
-            "config": {
-                "http_url": self.app.http_url,
-                "amqp_url": self.app.amqp_url,
-            },
+            "config": self.data_config(),
             "repos": repos,
             "revision": self.revision,
         }
 
+    def data_config(self):
+        return {
+            "http_url": self.app.http_url,
+            "amqp_url": self.app.amqp_url,
+        }
+
     def json(self):
-        return _json.dumps(self.data())
+        return self._computed_value("_json", self._encode_json)
 
-    def put_repo(self, repo_id, repo_data):
-        with self._lock:
-            repo = Repo(self, repo_id, None, **repo_data)
-            self.repos[repo_id] = repo
-            repo.mark_modified()
+    def _encode_json(self):
+        return b"".join((
+            b'{"config": ', _jsonlib.dumps(self.data_config()),
+            b', "repos": ', _encode_children(self.repos),
+            b', "revision": ', str(self.revision).encode("utf-8"),
+            b"}",
+        ))
 
-        return repo
+    def put_repo(self, repo_id, repo_data):
+        return self.apply([("put_repo", [repo_id], repo_data)])[0]
 
     def delete_repo(self, repo_id):
-        with self._lock:
-            del self.repos[repo_id]
-            self.mark_modified()
+        self.apply([("delete_repo", [repo_id], None)])
 
     def put_branch(self, repo_id, branch_id, branch_data):
+        return self.apply([("put_branch", [repo_id, branch_id], branch_data)])[0]
+
+    def delete_branch(self, repo_id, branch_id):
+        self.apply([("delete_branch", [repo_id, branch_id], None)])
+
+    def put_tag(self, repo_id, branch_id, tag_id, tag_data):
+        return self.apply([("put_tag", [repo_id, branch_id, tag_id], tag_data)])[0]
+
+    def delete_tag(self, repo_id, branch_id, tag_id):
+        self.apply([("delete_tag", [repo_id, branch_id, tag_id], None)])
+
+    def put_artifact(self, repo_id, branch_id, tag_id, artifact_id, artifact_data):
+        return self.apply([("put_artifact", [repo_id, branch_id, tag_id, artifact_id], artifact_data)])[0]
+
+    def delete_artifact(self, repo_id, branch_id, tag_id, artifact_id):
+        self.apply([("delete_artifact", [repo_id, branch_id, tag_id, artifact_id], None)])
+
+    def apply(self, operations):
+        """
+        Apply a sequence of (op, path, data) operations as one change.
+        Either all of them take effect or, if one fails, none do.  The
+        change gets one revision, one journal write, and one update
+        event per affected object.
+
+        Returns the object each operation put, or for deletes the
+        parent of the deleted object.  An empty sequence is not a
+        change and leaves the revision as it is.
+        """
+
+        if not operations:
+            return []
+
         with self._lock:
-            repo = self.repos.get(repo_id)
+            time = _now()
+            revision = self.revision + 1
+            objs = list()
+            journal_operations = list()
 
-            if repo is None:
-                repo = Repo(self, repo_id, None)
-                self.repos[repo_id] = repo
+            self._undo = list()
 
-            branch = Branch(self, branch_id, repo, **branch_data)
-            repo.branches[branch_id] = branch
+            try:
+                for op, path, data in operations:
+                    obj = self._apply(time, op, path, data)
+                    objs.append(obj)
+                    journal_operations.append(self._journal_operation(op, path, obj if data is not None else None))
+            except:
+                self._rollback()
+                raise
+            finally:
+                undo = self._undo
+                self._undo = None
+
+            changes = [["put", new.event_path] if new is not None else ["delete", old.event_path]
+                       for _, _, old, new in undo]
+
+            modified = dict()
+
+            for obj in objs:
+                while obj is not None and obj not in modified:
+                    obj._clear_computed_values()
+                    modified[obj] = None
+                    obj = obj._parent
+
+            change = (revision, [x.event_path for x in modified], changes)
 
-            branch.mark_modified()
+            self.mark_modified(change)
+            self._journal_records.append(self._journal_record(revision, time, journal_operations))
+            self._change_records.append(self._change_record(*change))
+            self._record_tag_history(revision, undo)
+
+        for obj in modified:
+            self.app.amqp_server.fire_object_update(obj, revision)
+            self.app.http_server.fire_object_update(obj, revision)
+
+        return objs
+
+    _operation_path_lengths = {
+        "put_repo": 1,
+        "delete_repo": 1,
+        "put_branch": 2,
+        "delete_branch": 2,
+        "put_tag": 3,
+        "delete_tag": 3,
+        "put_artifact": 4,
+        "delete_artifact": 4,
+    }
+
+    def _apply(self, time, op, path, data):
+        try:
+            path_length = self._operation_path_lengths[op]
+        except (KeyError, TypeError):
+            raise BadDataError(f"Unknown operation: {op}")
+
+        if not isinstance(path, list) or len(path) != path_length or not all(isinstance(x, str) for x in path):
+            raise BadDataError(f"Operation {op} requires a path of {path_length} IDs")
+
+        if op.startswith("put_"):
+            if not isinstance(data, dict):
+                raise BadDataError(f"Operation {op} requires object data")
+
+            return getattr(self, f"_{op}")(time, *path, data)
+
+        return getattr(self, f"_{op}")(time, *path)
+
+    # The operations below change the model without marking anything
+    # modified.  They are shared by apply() and journal replay.
+    # Parents created along the way take the operation time as their
+    # update time, so replay reproduces them exactly.
+    #
+    # All changes to the object tree go through _set() and _delete(),
+    # which record how to undo them while an apply() is in progress.
+
+    def _put_repo(self, time, repo_id, repo_data):
+        repo = Repo(self, repo_id, None, **repo_data)
+        self._set(self.repos, repo_id, repo)
+
+        return repo
+
+    def _delete_repo(self, time, repo_id):
+        self._delete(self.repos, repo_id)
+
+    def _put_branch(self, time, repo_id, branch_id, branch_data):
+        repo = self.repos.get(repo_id)
+
+        if repo is None:
+            repo = self._put_repo(time, repo_id, {"update_time": time})
+
+        branch = Branch(self, branch_id, repo, **branch_data)
+        self._set(repo.branches, branch_id, branch)
 
         return branch
 
-    def delete_branch(self, repo_id, branch_id):
-        with self._lock:
-            repo = self.repos[repo_id]
-            del repo.branches[branch_id]
-            repo.mark_modified()
+    def _delete_branch(self, time, repo_id, branch_id):
+        repo = self.repos[repo_id]
+        self._delete(repo.branches, branch_id)
 
-    def put_tag(self, repo_id, branch_id, tag_id, tag_data):
-        with self._lock:
-            repo = self.repos.get(repo_id)
+        return repo
 
-            if repo is None:
-                repo = Repo(self, repo_id, None)
-                self.repos[repo_id] = repo
+    def _put_tag(self, time, repo_id, branch_id, tag_id, tag_data):
+        repo = self.repos.get(repo_id)
+        branch = repo.branches.get(branch_id) if repo is not None else None
+
+        if branch is None:
+            branch = self._put_branch(time, repo_id, branch_id, {"update_time": time})
+
+        tag = Tag(self, tag_id, branch, **tag_data)
+        self._set(branch.tags, tag_id, tag)
+
+        return tag
+
+    def _delete_tag(self, time, repo_id, branch_id, tag_id):
+        branch = self.repos[repo_id].branches[branch_id]
+        self._delete(branch.tags, tag_id)
 
-            branch = repo.branches.get(branch_id)
+        return branch
+
+    def _put_artifact(self, time, repo_id, branch_id, tag_id, artifact_id, artifact_data):
+        try:
+            tag = self.repos[repo_id].branches[branch_id].tags[tag_id]
+        except KeyError:
+            tag = self._put_tag(time, repo_id, branch_id, tag_id, {"update_time": time})
 
-            if branch is None:
-                branch = Branch(self, branch_id, repo)
-                repo.branches[branch_id] = branch
+        artifact = Artifact.create(self, artifact_id, tag, **artifact_data)
+        self._set(tag.artifacts, artifact_id, artifact)
 
-            tag = Tag(self, tag_id, branch, **tag_data)
-            branch.tags[tag_id] = tag
+        return artifact
 
-            tag.mark_modified()
+    def _delete_artifact(self, time, repo_id, branch_id, tag_id, artifact_id):
+        tag = self.repos[repo_id].branches[branch_id].tags[tag_id]
+        self._delete(tag.artifacts, artifact_id)
 
         return tag
 
-    def delete_tag(self, repo_id, branch_id, tag_id):
-        with self._lock:
-            repo = self.repos[repo_id]
-            branch = repo.branches[branch_id]
+    def _set(self, children, id, obj):
+        old = children.get(id)
 
-            del branch.tags[tag_id]
+        if self._undo is not None:
+            self._undo.append((children, id, old, obj))
 
-            branch.mark_modified()
+        children[id] = obj
 
-    def put_artifact(self, repo_id, branch_id, tag_id, artifact_id, artifact_data):
-        with self._lock:
-            repo = self.repos.get(repo_id)
+        if old is not None:
+            self._unindex(old)
 
-            if repo is None:
-                repo = Repo(self, repo_id, None)
-                self.repos[repo_id] = repo
+        self._index(obj)
 
-            branch = repo.branches.get(branch_id)
+    def _delete(self, children, id):
+        obj = children.pop(id)
 
-            if branch is None:
-                branch = Branch(self, branch_id, repo)
-                repo.branches[branch_id] = branch
+        if self._undo is not None:
+            self._undo.append((children, id, obj, None))
 
-            tag = branch.tags.get(tag_id)
+        self._unindex(obj)
 
-            if tag is None:
-                tag = Tag(self, tag_id, branch)
-                branch.tags[tag_id] = tag
+    def _rollback(self):
+        # Readers may have cached values computed from the partial
+        # change, so the affected parents are cleared as well
 
-            artifact = Artifact.create(self, artifact_id, tag, **artifact_data)
-            tag.artifacts[artifact_id] = artifact
+        for children, id, old, new in reversed(self._undo):
+            if old is None:
+                del children[id]
+            else:
+                children[id] = old
 
-            artifact.mark_modified()
+            if new is not None:
+                self._unindex(new)
 
-        return artifact
+            if old is not None:
+                self._index(old)
 
-    def delete_artifact(self, repo_id, branch_id, tag_id, artifact_id):
-        with self._lock:
-            repo = self.repos[repo_id]
-            branch = repo.branches[branch_id]
-            tag = branch.tags[tag_id]
+            parent = (old or new)._parent
+
+            while parent is not None:
+                parent._clear_computed_values()
+                parent = parent._parent
+
+        with self._cache_lock:
+            self._cache_version += 1
+            self._json = None
+
+        self.compressed_cache.discard_all(self)
+
+    # An object enters the indexes with its whole subtree and leaves
+    # the same way, since a put replaces the subtree under it.  A
+    # subtree leaving the model drops its compressed bodies as well.
+    # The cache is keyed by object, so they would otherwise keep it
+    # alive until evicted.
+
+    def _index(self, obj):
+        objs = list(obj.walk())
+
+        with self._cache_lock:
+            for x in objs:
+                if isinstance(x, Tag):
+                    self._tags_by_update_time.add(_tag_sort_key(x), x)
+
+                    if x.commit_id is not None:
+                        self._tags_by_commit.add(str(x.commit_id), x)
+                elif isinstance(x, Artifact):
+                    self._artifacts_by_coordinates.add(x.coordinates(), x)
+
+    def _unindex(self, obj):
+        objs = list(obj.walk())
+
+        with self._cache_lock:
+            for x in objs:
+                if isinstance(x, Tag):
+                    self._tags_by_update_time.remove(_tag_sort_key(x))
+
+                    if x.commit_id is not None:
+                        self._tags_by_commit.remove(str(x.commit_id), x)
+                elif isinstance(x, Artifact):
+                    self._artifacts_by_coordinates.remove(x.coordinates(), x)
 
-            del tag.artifacts[artifact_id]
+        for x in objs:
+            self.compressed_cache.discard_all(x)
 
-            tag.mark_modified()
+    def _record_tag_history(self, revision, undo):
+        # Each replaced or removed tag is compared with the tag now at
+        # its path.  A tag that was replaced joins the history, and the
+        # history of a tag that is gone is dropped.  Artifact puts and
+        # deletes change a tag in place, so they become part of the
+        # version recorded when the tag is next replaced.
+
+        if self.tag_history_limit <= 0:
+            return
+
+        for _, _, old, _ in undo:
+            if old is None:
+                continue
+
+            for x in old.walk():
+                if not isinstance(x, Tag):
+                    continue
+
+                key = (x._parent._parent._id, x._parent._id, x._id)
+                current = self.find_object(x.event_path)
+
+                if current is x or current is None and key not in self._tag_history:
+                    continue
+
+                version = _tag_version(x) if current is not None else None
+                data = _encode_tag_version(*version) if version is not None else None
+
+                self._update_tag_history(key, revision, version)
+                self._history_records.append(self._history_record(revision, key, data))
+
+    def _update_tag_history(self, key, revision, version):
+        with self._cache_lock:
+            if version is None:
+                self._tag_history.pop(key, None)
+                return
+
+            tag_history = self._tag_history.get(key)
+
+            if tag_history is None:
+                tag_history = self._tag_history[key] = TagHistory(self.tag_history_limit)
+
+            tag_history.add(revision, *version)
+
+    def _history_record(self, revision, key, data):
+        line = _jsonlib.dumps({"revision": revision, "path": list(key)})
+        return line[:-1] + b', "data": ' + (data if data is not None else b"null") + b"}\n"
+
+    def _journal_record(self, revision, time, operations):
+        line = _jsonlib.dumps({"revision": revision, "time": time})
+        return line[:-1] + b', "operations": [' + b", ".join(operations) + b"]}\n"
+
+    def _journal_operation(self, op, path, obj=None):
+        operation = _jsonlib.dumps({"op": op, "path": path})
+
+        if obj is not None:
+            operation = operation[:-1] + b', "data": ' + obj.json() + b"}"
+
+        return operation
+
+    def _replay(self, record):
+        # Journals written before changes were recorded whole have a
+        # record for each operation
+
+        if "operations" not in record:
+            self._apply(record["time"], record["op"], record["path"], record.get("data"))
+            return
+
+        for operation in record["operations"]:
+            self._apply(record["time"], operation["op"], operation["path"], operation.get("data"))
 
 class BadDataError(Exception):
     pass
 
 class ModelObject:
+    # There are many model objects, so they use slots instead of a
+    # dict per instance.  Each subclass adds slots for its fields.
+    # Values repeated across objects, such as repository URLs, are
+    # interned so every object shares one copy.
+
+    __slots__ = ("_model", "_id", "_parent", "_version", "_json", "_digest", "update_time")
+
     _fields = []
     _required_fields = []
     _child_fields = []
+    _interned_fields = []
+
+    def __init_subclass__(cls):
+        super().__init_subclass__()
+        cls._value_fields = ["update_time"] + [x for x in cls._fields if x not in cls._child_fields]
 
     def __init__(self, model, id, parent, **fields):
         self._model = model
-        self._id = id
+        self._id = _intern(id)
         self._parent = parent
+        self._version = 0
+        self._json = None
         self._digest = None
-        self._compressed_data = None
 
         try:
             self.update_time = fields["update_time"]
         except KeyError:
-            self.update_time = round(_time.time() * 1000)
+            self.update_time = _now()
 
         missing = list()
 
@@ -231,11 +1041,17 @@ class ModelObject:
             raise BadDataError(f"{self} is missing required values: {', '.join(missing)}")
 
         for name in self._fields:
-            if name not in self._child_fields:
-                setattr(self, name, fields.get(name, None))
+            if name in self._child_fields:
+                continue
+
+            value = fields.get(name, None)
+
+            if name in self._interned_fields:
+                value = _intern(value)
+
+            setattr(self, name, value)
 
         self._init_children(**fields)
-        self._save_computed_values()
 
     def _init_children(self, **fields):
         assert not self._child_fields
@@ -252,48 +1068,87 @@ class ModelObject:
         return f"{self._parent.event_path}/{self._collection_name}/{self._id}"
 
     def data(self):
-        fields = dict()
+        fields = {name: getattr(self, name) for name in self._value_fields}
 
-        for name, value in vars(self).items():
-            if name.startswith("_"):
-                continue
+        for name in self._child_fields:
+            fields[name] = self._child_data(getattr(self, name))
 
-            if name in self._child_fields:
-                value = self._child_data(value)
+        return fields
 
-            fields[name] = value
+    def walk(self):
+        """
+        Generate this object and every object under it, parents
+        before children.
+        """
 
-        return fields
+        yield self
+
+        for name in self._child_fields:
+            for child in list(getattr(self, name).values()):
+                yield from child.walk()
 
     def _child_data(self, children):
         data = dict()
 
-        for child_id, child in children.items():
+        for child_id, child in list(children.items()):
             data[child_id] = child.data()
 
         return data
 
     def json(self):
-        return _json.dumps(self.data())
+        return self._computed_value("_json", self._encode_json)
 
-    def mark_modified(self):
-        self._mark_modified()
-        self._model.mark_modified()
+    def _encode_json(self):
+        # Children contribute their own cached JSON, so re-encoding a
+        # parent costs the size of its fields, not of its subtree.
+        # The child fields always come last.
 
-    def _mark_modified(self):
-        self._save_computed_values()
-        self._model.app.amqp_server.fire_object_update(self)
+        fields = {name: getattr(self, name) for name in self._value_fields}
+        json = _jsonlib.dumps(fields)
 
-        if self._parent is not None:
-            self._parent._mark_modified()
+        if self._child_fields:
+            children = [b'"' + name.encode("utf-8") + b'": ' + _encode_children(getattr(self, name))
+                        for name in self._child_fields]
+            json = b", ".join([json[:-1]] + children) + b"}"
 
-    def _save_computed_values(self):
-        json = self.json().encode("utf-8")
+        return json
 
-        self._compressed_data = _gzip.compress(json)
-        self._digest = _binascii.crc32(json)
+    def digest(self):
+        return self._computed_value("_digest", lambda: _binascii.crc32(self.json()))
+
+    def compressed_data(self, encoding="gzip"):
+        return self._model.compressed_cache.compute((self, encoding), self._version,
+                                                    lambda: _compress(self.json(), encoding))
+
+    # The computed values are produced on first use and dropped when
+    # the object or one of its children changes.  The version check
+    # keeps a computation that raced with a change from storing a
+    # stale value.
+
+    def _computed_value(self, name, compute):
+        value = getattr(self, name)
+
+        if value is None:
+            version = self._version
+            value = compute()
+
+            with self._model._cache_lock:
+                if self._version == version:
+                    setattr(self, name, value)
+
+        return value
+
+    def _clear_computed_values(self):
+        with self._model._cache_lock:
+            self._version += 1
+            self._json = None
+            self._digest = None
+
+        self._model.compressed_cache.discard_all(self)
 
 class Repo(ModelObject):
+    __slots__ = ("source_url", "job_url", "branches")
+
     type_name = "repo"
     _fields = ["source_url", "job_url", "branches"]
     _child_fields = ["branches"]
@@ -303,7 +1158,7 @@ class Repo(ModelObject):
 
         for branch_id, branch_data in fields.get("branches", {}).items():
             branch = Branch(self._model, branch_id, self, **branch_data)
-            self.branches[branch_id] = branch
+            self.branches[branch._id] = branch
 
     @property
     def api_path(self):
@@ -314,6 +1169,8 @@ class Repo(ModelObject):
         return f"events/repos/{self._id}"
 
 class Branch(ModelObject):
+    __slots__ = ("tags",)
+
     type_name = "branch"
     _collection_name = "branches"
     _fields = ["tags"]
@@ -324,9 +1181,11 @@ class Branch(ModelObject):
 
         for tag_id, tag_data in fields.get("tags", {}).items():
             tag = Tag(self._model, tag_id, self, **tag_data)
-            self.tags[tag_id] = tag
+            self.tags[tag._id] = tag
 
 class Tag(ModelObject):
+    __slots__ = ("build_id", "build_url", "commit_id", "commit_url", "artifacts")
+
     type_name = "tag"
     _collection_name = "tags"
     _fields = ["build_id", "build_url", "commit_id", "commit_url", "artifacts"]
@@ -337,9 +1196,11 @@ class Tag(ModelObject):
 
         for artifact_id, artifact_data in fields.get("artifacts", {}).items():
             artifact = Artifact.create(self._model, artifact_id, self, **artifact_data)
-            self.artifacts[artifact_id] = artifact
+            self.artifacts[artifact._id] = artifact
 
 class Artifact(ModelObject):
+    __slots__ = ()
+
     type_name = "artifact"
     _collection_name = "artifacts"
 
@@ -355,21 +1216,45 @@ class Artifact(ModelObject):
 
         return obj
 
+    def coordinates(self):
+        """
+        Return the type and the coordinate field values that identify
+        what this artifact holds, as strings for lookup.
+        """
+
+        return (self.type, *[str(getattr(self, x)) for x in self._coordinate_fields])
+
 class ContainerArtifact(Artifact):
+    __slots__ = ("type", "registry_url", "repository", "image_id")
+
     _fields = ["type", "registry_url", "repository", "image_id"]
     _required_fields = _fields
+    _interned_fields = ["type", "registry_url", "repository"]
+    _coordinate_fields = ["image_id"]
 
 class MavenArtifact(Artifact):
+    __slots__ = ("type", "repository_url", "group_id", "artifact_id", "version")
+
     _fields = ["type", "repository_url", "group_id", "artifact_id", "version"]
     _required_fields = _fields
+    _interned_fields = ["type", "repository_url", "group_id", "artifact_id", "version"]
+    _coordinate_fields = ["group_id", "artifact_id", "version"]
 
 class FileArtifact(Artifact):
+    __slots__ = ("type", "url")
+
     _fields = ["type", "url"]
     _required_fields = _fields
+    _interned_fields = ["type"]
+    _coordinate_fields = ["url"]
 
 class RpmArtifact(Artifact):
+    __slots__ = ("type", "repository_url", "name", "version", "release")
+
     _fields = ["type", "repository_url", "name", "version", "release"]
     _required_fields = _fields
+    _interned_fields = ["type", "repository_url", "name", "version", "release"]
+    _coordinate_fields = ["name", "version", "release"]
 
 Artifact._subclasses_by_type = {
     "container": ContainerArtifact,
@@ -378,6 +1263,269 @@ Artifact._subclasses_by_type = {
     "rpm": RpmArtifact,
 }
 
+_type_names = ["repo", "branch", "tag", "artifact"]
+
+class SortedIndex:
+    """
+    Objects in the order of their keys.  Keys are unique tuples.
+    Finding a position costs log n, and adding or removing an object
+    costs a list insertion.
+    """
+
+    def __init__(self):
+        self._entries = list()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key, obj):
+        _bisect.insort(self._entries, (key, obj), key=lambda x: x[0])
+
+    def remove(self, key):
+        index = _bisect.bisect_left(self._entries, key, key=lambda x: x[0])
+
+        if index < len(self._entries) and self._entries[index][0] == key:
+            del self._entries[index]
+
+    def page(self, limit, after=None, reverse=False):
+        """
+        Return up to limit (key, object) entries following the key
+        after, in reverse order if reverse is set.
+        """
+
+        if reverse:
+            end = len(self._entries)
+
+            if after is not None:
+                end = _bisect.bisect_left(self._entries, after, key=lambda x: x[0])
+
+            return self._entries[max(0, end - limit):end][::-1]
+
+        start = 0
+
+        if after is not None:
+            start = _bisect.bisect_right(self._entries, after, key=lambda x: x[0])
+
+        return self._entries[start:start + limit]
+
+class CompressedCache:
+    """
+    Compressed bodies by object and encoding, least recently used
+    first, up to budget bytes in all.  A body is returned only for the
+    version of the object it was made from.  A body larger than the
+    budget is not kept.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+
+        self._entries = _collections.OrderedDict()
+        self._lock = _threading.Lock()
+
+    def compute(self, key, version, compute):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                return entry[1]
+
+        value = compute()
+
+        if len(value) <= self.budget:
+            with self._lock:
+                self._remove(key)
+                self._entries[key] = (version, value)
+                self.size += len(value)
+
+                while self.size > self.budget:
+                    self._remove(next(iter(self._entries)))
+
+        return value
+
+    def discard_all(self, obj):
+        with self._lock:
+            for encoding in compressed_encodings:
+                self._remove((obj, encoding))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+
+        if entry is not None:
+            self.size -= len(entry[1])
+
+class TagHistory:
+    """
+    The previous versions of one tag, newest last, up to limit.  Each
+    is stored with the revision that replaced it.  The newest version
+    is kept whole, as the tag's field values and the JSON of each of
+    its artifacts.  Each older version keeps only what differs from
+    the version after it: the changed fields, the changed artifacts,
+    and the artifact IDs in order.  Artifact JSON is shared with the
+    objects it came from, not copied.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.entries = _collections.deque()
+
+    def add(self, revision, fields, artifacts):
+        if self.entries:
+            # The version that was newest is now stored against this one
+
+            older_revision, older_fields, older_artifacts, _ = self.entries[-1]
+
+            changed_fields = {k: v for k, v in older_fields.items() if fields.get(k, _missing) != v}
+            changed_artifacts = {k: v for k, v in older_artifacts.items() if artifacts.get(k) != v}
+
+            self.entries[-1] = (older_revision, changed_fields, changed_artifacts, tuple(older_artifacts))
+
+        self.entries.append((revision, fields, artifacts, None))
+
+        while len(self.entries) > self.limit:
+            self.entries.popleft()
+
+    @staticmethod
+    def expand(entries, limit=None):
+        """
+        Return (revision, JSON) for up to limit versions from a copy
+        of the entries, newest first.
+        """
+
+        versions = list()
+        fields = artifacts = None
+
+        for revision, entry_fields, entry_artifacts, order in reversed(entries):
+            if limit is not None and len(versions) >= limit:
+                break
+
+            if order is None:
+                fields, artifacts = entry_fields, entry_artifacts
+            else:
+                fields = {**fields, **entry_fields}
+                artifacts = {x: entry_artifacts[x] if x in entry_artifacts else artifacts[x] for x in order}
+
+            versions.append((revision, _encode_tag_version(fields, artifacts)))
+
+        return versions
+
+class MultiIndex:
+    """
+    Objects grouped by key, in the order they were added.  Adding,
+    removing, and looking up an object each cost a dict operation.
+    """
+
+    def __init__(self):
+        self._objects = dict()
+
+    def add(self, key, obj):
+        self._objects.setdefault(key, dict())[obj] = None
+
+    def remove(self, key, obj):
+        objs = self._objects.get(key)
+
+        if objs is not None:
+            objs.pop(obj, None)
+
+            if not objs:
+                del self._objects[key]
+
+    def get(self, key):
+        return list(self._objects.get(key, ()))
+
+_missing = object()
+
+def _tag_version(tag):
+    fields = {name: getattr(tag, name) for name in tag._value_fields}
+    artifacts = {artifact_id: artifact.json() for artifact_id, artifact in list(tag.artifacts.items())}
+
+    return fields, artifacts
+
+def _tag_version_of_data(data):
+    fields = {name: data.get(name) for name in Tag._value_fields}
+    artifacts = {_intern(k): _jsonlib.dumps(v) for k, v in data.get("artifacts", {}).items()}
+
+    return fields, artifacts
+
+def _encode_tag_version(fields, artifacts):
+    items = [_jsonlib.dumps(k) + b": " + v for k, v in artifacts.items()]
+    return _jsonlib.dumps(fields)[:-1] + b', "artifacts": {' + b", ".join(items) + b"}}"
+
+def _tag_sort_key(tag):
+    branch = tag._parent
+    update_time = tag.update_time if isinstance(tag.update_time, int) else 0
+
+    return (update_time, branch._parent._id, branch._id, tag._id)
+
+def _ancestor_paths(path):
+    segments = path.split("/")
+    return ["/".join(segments[:i]) for i in range(3, len(segments), 2)]
+
+def _encode_entry(obj):
+    ids = list()
+    parent = obj
+
+    while parent is not None:
+        ids.append(parent._id)
+        parent = parent._parent
+
+    return b'{"path": ' + _jsonlib.dumps(ids[::-1]) + b', "data": ' + obj.json() + b"}"
+
+def _encode_cursor(key):
+    return _base64.urlsafe_b64encode(_jsonlib.dumps(key)).decode("ascii")
+
+def _decode_cursor(cursor):
+    try:
+        key = _jsonlib.loads(_base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, UnicodeError):
+        raise ValueError(f"Illegal cursor: {cursor}")
+
+    if not isinstance(key, list) or len(key) != 4 or not isinstance(key[0], int) \
+       or not all(isinstance(x, str) for x in key[1:]):
+        raise ValueError(f"Illegal cursor: {cursor}")
+
+    return tuple(key)
+
+# The supported encodings, most preferred first.  Brotli and zstd are
+# used when their modules are installed.
+
+compressed_encodings = [x for x, module in (("br", _brotli), ("zstd", _zstandard), ("gzip", _gzip))
+                        if module is not None]
+
+def _compress(data, encoding, snapshot=False):
+    # Objects are small and change often, so they get fast settings.
+    # The costlier high ratio settings are kept for the full snapshot,
+    # the one large body.
+
+    if encoding == "gzip":
+        return _gzip.compress(data)
+
+    if encoding == "br":
+        return _brotli.compress(data, quality=9 if snapshot else 4)
+
+    if encoding == "zstd":
+        return _zstandard.ZstdCompressor(level=10 if snapshot else 3).compress(data)
+
+    raise ValueError(f"Unknown encoding: {encoding}")
+
+def _intern(value):
+    if isinstance(value, str):
+        return _sys.intern(value)
+
+    return value
+
+def _now():
+    return round(_time.time() * 1000)
+
+def _encode_children(children):
+    items = list()
+
+    for child_id, child in list(children.items()):
+        items.append(_jsonlib.dumps(child_id) + b": " + child.json())
+
+    return b"{" + b", ".join(items) + b"}"
+
 class SaveThread(_threading.Thread):
     def __init__(self, model):
         super().__init__()
@@ -387,11 +1535,17 @@ class SaveThread(_threading.Thread):
 
     def run(self):
         while self.model._modified.wait():
+            self.model._modified.clear()
+
             try:
                 self.model.save()
             except KeyboardInterrupt:
                 raise
             except Exception:
                 _traceback.print_exc()
-            finally:
-                self.model._modified.clear()
+
+                # The records were kept, so try again shortly even if
+                # nothing else changes
+
+                _time.sleep(1)
+                self.model._modified.set()
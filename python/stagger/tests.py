@@ -17,10 +17,18 @@
 # under the License.
 #
 
+import json as _json
+import proton as _proton
+import requests as _requests
+
 from commandant import TestSkipped
 from fortworth import *
+from proton.reactor import Filter
+from proton.utils import BlockingConnection
 from requests.exceptions import HTTPError
 
+from .amqpserver import OutboundQueue, SubscriptionTree
+
 container_artifact_data = {
     "type": "container",
     "registry_url": "https://registry.example.com/",
@@ -128,6 +136,259 @@ def test_api_data(session):
     with TestServer() as server:
         get(f"{server.http_url}/api/data")
 
+def test_api_data_since(session):
+    tag_path = ["example-app-dist", "master", "tested"]
+
+    with TestServer() as server:
+        url = f"{server.http_url}/api/data"
+
+        stagger_put_tag(*tag_path, tag_data, service_url=server.http_url)
+        revision = stagger_get_data(service_url=server.http_url)["revision"]
+        stagger_put_tag(*tag_path, tag_data, service_url=server.http_url)
+
+        response = _requests.get(f"{url}?since={revision}")
+        response.raise_for_status()
+        delta = response.json()
+
+        assert delta["since"] == revision, delta
+        assert delta["revision"] == revision + 1, delta
+        assert [x["op"] for x in delta["operations"]] == ["put_tag"], delta
+        assert delta["operations"][0]["path"] == tag_path, delta
+
+        response = _requests.get(f"{url}?since={revision + 2}")
+        assert response.status_code == 410, response.status_code
+
+        response = _requests.get(f"{url}?since=x")
+        assert response.status_code == 400, response.status_code
+
+        headers = {"Accept": "text/event-stream", "Last-Event-ID": str(revision)}
+
+        with _requests.get(url, headers=headers, stream=True) as response:
+            lines = response.iter_lines()
+
+            assert next(lines) == f"id: {revision + 1}".encode("utf-8")
+            assert next(lines) == b"event: delta"
+
+            delta = _json.loads(next(lines)[len(b"data: "):])
+
+            assert delta["since"] == revision, delta
+
+        with _requests.get(url, headers={"Accept": "text/event-stream"}, stream=True) as response:
+            lines = response.iter_lines()
+
+            assert next(lines) == b"event: reset"
+
+def test_api_watch(session):
+    tag_path = ["example-app-dist", "master", "tested"]
+
+    with TestServer() as server:
+        stagger_put_tag(*tag_path, tag_data, service_url=server.http_url)
+
+        url = f"{server.http_url}/api/watch/repos/{'/branches/'.join(tag_path[:2])}/tags/{tag_path[2]}"
+        etag = _requests.head(url.replace("/watch", "")).headers["ETag"]
+
+        response = _requests.get(f"{url}?timeout=0.1", headers={"If-None-Match": etag})
+        assert response.status_code == 304, response.status_code
+
+        headers = {"Accept": "text/event-stream", "Last-Event-ID": "0"}
+
+        with _requests.get(f"{server.http_url}/api/watch/repos/*", headers=headers, stream=True) as response:
+            lines = response.iter_lines()
+
+            assert next(lines) == b"id: 1", "Expected a replayed event"
+            assert next(lines) == b"event: update"
+
+            event = _json.loads(next(lines)[len(b"data: "):])
+
+            assert event["path"] == "events/repos/example-app-dist", event
+            assert event["type"] == "repo", event
+
+def test_api_tags(session):
+    with TestServer() as server:
+        url = f"{server.http_url}/api/tags"
+
+        for update_time, tag_id in enumerate(("one", "two", "three")):
+            stagger_put_tag("example-app-dist", "master", tag_id, dict(tag_data, update_time=update_time),
+                            service_url=server.http_url)
+
+        response = _requests.get(f"{url}?sort=update_time&limit=2")
+        response.raise_for_status()
+        page = response.json()
+
+        assert [x["path"][2] for x in page["tags"]] == ["one", "two"], page
+        assert page["next_cursor"] is not None, page
+
+        response = _requests.get(f"{url}?sort=update_time&limit=2&cursor={page['next_cursor']}")
+        response.raise_for_status()
+        page = response.json()
+
+        assert [x["path"][2] for x in page["tags"]] == ["three"], page
+        assert page["next_cursor"] is None, page
+
+        response = _requests.get(url)
+        response.raise_for_status()
+        page = response.json()
+
+        assert [x["path"][2] for x in page["tags"]] == ["three", "two", "one"], page
+
+        for query in ("sort=x", "limit=0", "cursor=x"):
+            response = _requests.get(f"{url}?{query}")
+            assert response.status_code == 400, (query, response.status_code)
+
+def test_api_artifacts(session):
+    with TestServer() as server:
+        url = f"{server.http_url}/api/artifacts"
+
+        stagger_put_tag("example-app-dist", "master", "tested", tag_data, service_url=server.http_url)
+        stagger_put_tag("example-app-dist", "master", "released", tag_data, service_url=server.http_url)
+
+        response = _requests.get(url, params={"type": "rpm", "name": "example-app", "version": "1.0.0", "release": "999"})
+        response.raise_for_status()
+        data = response.json()
+
+        assert sorted(x["path"][2] for x in data["artifacts"]) == ["released", "tested"], data
+        assert all(x["path"][3] == "example-app-rpm" for x in data["artifacts"]), data
+
+        response = _requests.get(url, params={"type": "container", "image_id": "none"})
+        response.raise_for_status()
+
+        assert response.json()["artifacts"] == [], response.json()
+
+        for params in ({"type": "x"}, {"type": "rpm", "name": "example-app"}):
+            response = _requests.get(url, params=params)
+            assert response.status_code == 400, (params, response.status_code)
+
+def test_api_commits(session):
+    with TestServer() as server:
+        commit_id = tag_data["commit_id"]
+        url = f"{server.http_url}/api/commits/{commit_id}"
+
+        stagger_put_tag("example-app-dist", "master", "tested", tag_data, service_url=server.http_url)
+        stagger_put_tag("example-app-dist", "master", "released", tag_data, service_url=server.http_url)
+
+        response = _requests.get(url)
+        response.raise_for_status()
+        data = response.json()
+
+        assert data["commit_id"] == commit_id, data
+        assert sorted(x["path"][2] for x in data["tags"]) == ["released", "tested"], data
+
+        stagger_put_tag("example-app-dist", "master", "released", dict(tag_data, commit_id="abc"),
+                        service_url=server.http_url)
+
+        data = _requests.get(url).json()
+
+        assert [x["path"][2] for x in data["tags"]] == ["tested"], data
+
+        response = _requests.get(f"{server.http_url}/api/commits/none")
+        assert response.status_code == 404, response.status_code
+
+def test_api_tag_history(session):
+    tag_path = ["example-app-dist", "master", "tested"]
+
+    with TestServer() as server:
+        url = f"{server.http_url}/api/repos/{tag_path[0]}/branches/{tag_path[1]}/tags/{tag_path[2]}/history"
+
+        for build_id in ("1", "2", "3"):
+            stagger_put_tag(*tag_path, dict(tag_data, build_id=build_id), service_url=server.http_url)
+
+        response = _requests.get(url)
+        response.raise_for_status()
+        data = response.json()
+
+        assert [x["data"]["build_id"] for x in data["history"]] == ["2", "1"], data
+
+        data = _requests.get(f"{url}?limit=1").json()
+
+        assert [x["data"]["build_id"] for x in data["history"]] == ["2"], data
+
+        stagger_put_artifact(*tag_path, "example-app-container", container_artifact_data,
+                             service_url=server.http_url)
+
+        data = _requests.get(url).json()
+
+        assert [x["data"]["build_id"] for x in data["history"]] == ["2", "1"], data
+
+        stagger_put_tag(*tag_path, dict(tag_data, build_id="4"), service_url=server.http_url)
+
+        data = _requests.get(f"{url}?limit=1").json()
+        artifacts = data["history"][0]["data"]["artifacts"]
+
+        assert data["history"][0]["data"]["build_id"] == "3", data
+        assert "example-app-container" in artifacts and "example-app-rpm" in artifacts, data
+
+        response = _requests.get(url.replace("/tested/", "/none/"))
+        assert response.status_code == 404, response.status_code
+
+def test_api_compression(session):
+    tag_path = ["example-app-dist", "master", "tested"]
+
+    with TestServer() as server:
+        stagger_put_tag(*tag_path, tag_data, service_url=server.http_url)
+
+        for path in ("data", "repos/example-app-dist/branches/master/tags/tested"):
+            url = f"{server.http_url}/api/{path}"
+
+            for i in range(2):
+                response = _requests.get(url, headers={"Accept-Encoding": "gzip"})
+                response.raise_for_status()
+
+                assert response.headers["Content-Encoding"] == "gzip", response.headers
+                assert response.json() == _requests.get(url, headers={"Accept-Encoding": "identity"}).json()
+
+            response = _requests.get(url, headers={"Accept-Encoding": "br;q=0, zstd;q=0, gzip;q=0.5"})
+            assert response.headers["Content-Encoding"] == "gzip", response.headers
+
+            response = _requests.get(url, headers={"Accept-Encoding": "gzip;q=0.5, identity"})
+            assert "Content-Encoding" not in response.headers, response.headers
+
+def test_api_batch(session):
+    tag_path = ["example-app-dist", "master", "tested"]
+
+    batch_data = [
+        {"op": "put_tag", "path": tag_path, "data": tag_data},
+        {"op": "put_artifact", "path": tag_path + ["example-app-container"], "data": container_artifact_data},
+        {"op": "delete_artifact", "path": tag_path + ["example-app-rpm"]},
+    ]
+
+    bad_batch_data = [
+        {"op": "delete_tag", "path": tag_path},
+        {"op": "put_artifact", "path": tag_path + ["example-app-container"], "data": {"type": "container"}},
+    ]
+
+    with TestServer() as server:
+        revision = stagger_get_data(service_url=server.http_url)["revision"]
+
+        post(f"{server.http_url}/api/batch", [])
+
+        assert stagger_get_data(service_url=server.http_url)["revision"] == revision
+
+        post(f"{server.http_url}/api/batch?dry-run=1", batch_data)
+
+        try:
+            stagger_get_tag(*tag_path, service_url=server.http_url)
+            assert False, "Expected this to 404"
+        except HTTPError as e:
+            assert e.response.status_code == 404, "Expected this to 404"
+
+        post(f"{server.http_url}/api/batch", batch_data)
+
+        data = stagger_get_tag(*tag_path, service_url=server.http_url)
+
+        assert "example-app-container" in data["artifacts"], data
+        assert "example-app-rpm" not in data["artifacts"], data
+
+        try:
+            post(f"{server.http_url}/api/batch", bad_batch_data)
+            assert False, "Expected this to fail"
+        except CalledProcessError:
+            pass
+
+        response = _requests.post(f"{server.http_url}/api/batch", data=b"[{\"op\": ")
+        assert response.status_code == 400, response.status_code
+
+        stagger_get_tag(*tag_path, service_url=server.http_url)
+
 def _test_api_curl(session, path, data):
     with TestServer() as server:
         url = f"{server.http_url}/api/{path}"
@@ -184,6 +445,58 @@ def _test_api_artifact(session, repo, branch, tag, artifact, artifact_data):
 
     _test_api_curl(session, f"repos/{repo}/branches/{branch}/tags/{tag}/artifacts/{artifact}", artifact_data)
 
+def test_persistence(session):
+    data_dir = make_temp_dir()
+
+    with TestServer(data_dir=data_dir) as server:
+        stagger_put_tag("example-app-dist", "master", "tested", tag_data, service_url=server.http_url)
+        stagger_put_artifact("example-app-dist", "master", "tested", "example-app-container", container_artifact_data, service_url=server.http_url)
+        delete(f"{server.http_url}/api/repos/example-app-dist/branches/master/tags/tested/artifacts/example-app-rpm")
+        sleep(0.5)
+
+    with TestServer(data_dir=data_dir) as server:
+        data = stagger_get_tag("example-app-dist", "master", "tested", service_url=server.http_url)
+
+        assert "example-app-container" in data["artifacts"], data
+        assert "example-app-rpm" not in data["artifacts"], data
+
+def test_persistence_events(session):
+    data_dir = make_temp_dir()
+    events_file = join(data_dir, "data.events")
+
+    with TestServer(data_dir=data_dir) as server:
+        for i in range(4):
+            stagger_put_tag("example-app-dist", "master", f"tag-{i}", tag_data, service_url=server.http_url)
+
+        revision = stagger_get_data(service_url=server.http_url)["revision"]
+        sleep(0.5)
+
+    # Drop a change in the middle and tear the last record
+
+    lines = read_lines(events_file)
+    del lines[1]
+    lines[-1] = lines[-1][:10]
+
+    write(events_file, "".join(lines))
+
+    with TestServer(data_dir=data_dir) as server:
+        url = f"{server.http_url}/api/data"
+
+        response = _requests.get(f"{url}?since={revision - 3}")
+        assert response.status_code == 410, response.status_code
+
+        response = _requests.get(f"{url}?since={revision - 2}")
+        assert response.status_code == 410, response.status_code
+
+        stagger_put_tag("example-app-dist", "master", "tag-4", tag_data, service_url=server.http_url)
+        sleep(0.5)
+
+    with TestServer(data_dir=data_dir) as server:
+        response = _requests.get(f"{server.http_url}/api/data?since={revision}")
+        response.raise_for_status()
+
+        assert response.json()["revision"] == revision + 1, response.json()
+
 def test_events_repo(session):
     _test_events(session, "repos/example-app-dist", repo_data)
 
@@ -225,6 +538,154 @@ def _test_events(session, path, data):
             put(api_url, data)
             check_process(proc)
 
+def test_events_wildcards(session):
+    tag_path = ["example-app-dist", "master", "tested"]
+    tag_event_path = "events/repos/example-app-dist/branches/master/tags/tested"
+
+    addresses = {
+        "events/repos/*/branches/master/tags/*": 1,
+        "events/repos/example-app-dist/#": 3,
+        "events": 3,
+    }
+
+    with TestServer() as server:
+        stagger_put_tag(*tag_path, tag_data, service_url=server.http_url)
+
+        for address, count in addresses.items():
+            with amqp_receiver(server.amqp_url, address) as receiver:
+                stagger_put_tag(*tag_path, tag_data, service_url=server.http_url)
+
+                paths = [x.properties["path"] for x in receive_messages(receiver, count)]
+
+                assert tag_event_path in paths, (address, paths)
+
+        with amqp_receiver(server.amqp_url, "events/repos/*/branches/other/#") as receiver:
+            stagger_put_tag(*tag_path, tag_data, service_url=server.http_url)
+
+            try:
+                receiver.receive(timeout=1)
+                assert False, "Expected no message"
+            except _proton.Timeout:
+                pass
+
+def test_events_since_revision(session):
+    tag_path = ["example-app-dist", "master", "tested"]
+    artifact_path = tag_path + ["example-app-container"]
+
+    with TestServer() as server:
+        stagger_put_tag(*tag_path, tag_data, service_url=server.http_url)
+        revision = stagger_get_data(service_url=server.http_url)["revision"]
+        stagger_put_artifact(*artifact_path, container_artifact_data, service_url=server.http_url)
+
+        # The artifact put changed the artifact and each of its parents
+
+        with amqp_receiver(server.amqp_url, "events", since_revision=revision) as receiver:
+            messages = receive_messages(receiver, 4)
+
+        paths = {x.properties["path"] for x in messages}
+        artifact_event_path = "events/repos/example-app-dist/branches/master/tags/tested/artifacts/example-app-container"
+
+        assert len(paths) == 4 and artifact_event_path in paths, paths
+        assert all(x.properties["revision"] == revision + 1 for x in messages), messages
+
+        with amqp_receiver(server.amqp_url, "events/repos/*/branches/*/tags/*", since_revision=revision) as receiver:
+            message = receive_messages(receiver, 1)[0]
+
+            assert message.properties["path"].endswith("/tags/tested"), message
+            assert _json.loads(bytes(message.body))["build_id"] == tag_data["build_id"], message
+
+            try:
+                receiver.receive(timeout=1)
+                assert False, "Expected only the tag to be replayed"
+            except _proton.Timeout:
+                pass
+
+def test_events_queueing(session):
+    tag_path = ["example-app-dist", "master", "tested"]
+
+    with TestServer() as server:
+        stagger_put_tag(*tag_path, tag_data, service_url=server.http_url)
+
+        # The receiver grants no credit until it receives, so updates
+        # wait in the link's queue.  Only the latest one for the tag
+        # is kept.  The puts are spaced out so the server sends each
+        # one instead of combining them before they reach the queue.
+
+        with amqp_receiver(server.amqp_url, "events/repos/*/branches/*/tags/*") as receiver:
+            for build_id in ("1", "2", "3"):
+                stagger_put_tag(*tag_path, dict(tag_data, build_id=build_id), service_url=server.http_url)
+                sleep(0.5)
+
+            message = receive_messages(receiver, 1)[0]
+
+            assert _json.loads(bytes(message.body))["build_id"] == "3", message
+
+            try:
+                receiver.receive(timeout=1)
+                assert False, "Expected the earlier updates to be replaced"
+            except _proton.Timeout:
+                pass
+
+def test_subscription_tree(session):
+    tree = SubscriptionTree()
+
+    addresses = [
+        "events/repos/a",
+        "events/repos/*",
+        "events/repos/a/#",
+        "events/repos/*/branches/b",
+        "events",
+    ]
+
+    for address in addresses:
+        tree.add(address, address)
+
+    def match(path):
+        return sorted(tree.match(path))
+
+    assert match("events/repos/a") == sorted(["events/repos/a", "events/repos/*", "events/repos/a/#", "events"])
+    assert match("events/repos/c") == sorted(["events/repos/*", "events"])
+    assert match("events/repos/a/branches/b") == sorted(["events/repos/a/#", "events/repos/*/branches/b", "events"])
+    assert match("events/repos/c/branches/d") == ["events"]
+    assert match("other") == []
+
+    for address in addresses:
+        tree.remove(address, address)
+
+    assert match("events/repos/a") == []
+    assert not tree.root.children, tree.root.children
+
+def test_outbound_queue(session):
+    queue = OutboundQueue(2)
+
+    queue.push("a", 1)
+    queue.push("b", 2)
+    queue.push("a", 3)
+
+    assert len(queue) == 2, len(queue)
+
+    queue.push("c", 4)
+
+    assert [queue.pop() for i in range(len(queue))] == [3, 4]
+
+    queue = OutboundQueue(2, "drop-oldest")
+
+    for i, path in enumerate(("a", "a", "b")):
+        queue.push(path, i)
+
+    assert [queue.pop() for i in range(len(queue))] == [1, 2]
+
+    for i in range(3):
+        queue.push("a", i, bounded=False)
+
+    assert len(queue) == 3, len(queue)
+
+    try:
+        OutboundQueue(2, "drop-newest")
+        assert False, "Expected a ValueError"
+    except ValueError:
+        pass
+
 def test_html_endpoints(session):
     with TestServer() as server:
         stagger_put_tag("example-app-dist", "master", "tested", tag_data, service_url=server.http_url)
@@ -259,6 +720,12 @@ def put(url, data):
         print(f"PUT {url} -> ", end="", flush=True)
         call("curl -X PUT {} --data @{} {}", url, data_file, curl_options)
 
+def post(url, data):
+    with temp_file() as data_file:
+        write_json(data_file, data)
+        print(f"POST {url} -> ", end="", flush=True)
+        call("curl -X POST {} --data @{} {}", url, data_file, curl_options)
+
 def get(url):
     print(f"GET {url} -> ", end="", flush=True)
     call("curl {} {}", url, curl_options)
@@ -274,11 +741,38 @@ def delete(url):
 def receive(url, count):
     return start_process("qreceive --count {} {}", count, url)
 
+class amqp_receiver:
+    def __init__(self, url, address, since_revision=None):
+        self.url = url
+        self.address = address
+        self.options = None
+
+        if since_revision is not None:
+            self.options = Filter({_proton.symbol("since-revision"): since_revision})
+
+    def __enter__(self):
+        self.connection = BlockingConnection(self.url, timeout=10)
+        return self.connection.create_receiver(self.address, options=self.options)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.close()
+
+def receive_messages(receiver, count):
+    messages = list()
+
+    for i in range(count):
+        messages.append(receiver.receive(timeout=10))
+        receiver.accept()
+
+    return messages
+
 class TestServer(object):
-    def __init__(self):
+    def __init__(self, data_dir=None):
         http_port = random_port()
         amqp_port = random_port()
-        data_dir = make_temp_dir()
+
+        if data_dir is None:
+            data_dir = make_temp_dir()
 
         with working_env(STAGGER_HTTP_PORT_=http_port, STAGGER_AMQP_PORT_=amqp_port, STAGGER_DATA_DIR=data_dir):
             self.proc = start_process("stagger")
@@ -265,19 +265,72 @@ class Gesso {
         }
 
         for (let row of rows) {
-            let tr = this.createElement(tbody, "tr");
+            this._createTableRow(tbody, row);
+        }
+
+        return elem;
+    }
+
+    _createTableRow(parent, row) {
+        let tr = this.createElement(parent, "tr");
+
+        for (let cell of row) {
+            let td = this.createElement(tr, "td");
+
+            if (cell instanceof Node) {
+                td.appendChild(cell);
+            } else {
+                this.createText(td, cell);
+            }
+        }
+
+        return tr;
+    }
 
-            for (let cell of row) {
-                let td = this.createElement(tr, "td");
+    // Update the rows of a table from createTable in place.  Each row
+    // is {key, version, cells}, where cells is a function returning
+    // the row's cells.  Only rows with a new key or a changed version
+    // are built.  The rest keep their elements and move as needed.
 
-                if (cell instanceof Node) {
-                    td.appendChild(cell);
-                } else {
-                    this.createText(td, cell);
+    updateTable(elem, rows) {
+        let tbody = elem.$("tbody");
+        let oldRows = elem._keyedRows || new Map();
+        let newRows = new Map();
+        let next = tbody.firstChild;
+
+        for (let row of rows) {
+            let entry = oldRows.get(row.key);
+
+            if (entry != null && entry.version !== row.version) {
+                if (entry.tr === next) {
+                    next = next.nextSibling;
                 }
+
+                entry.tr.remove();
+                entry = null;
+            }
+
+            if (entry == null) {
+                entry = {tr: this._createTableRow(null, row.cells()), version: row.version};
+            }
+
+            if (entry.tr === next) {
+                next = next.nextSibling;
+            } else {
+                tbody.insertBefore(entry.tr, next);
             }
+
+            newRows.set(row.key, entry);
         }
 
+        for (let [key, entry] of oldRows) {
+            if (newRows.get(key) !== entry) {
+                entry.tr.remove();
+            }
+        }
+
+        elem._keyedRows = newRows;
+
         return elem;
     }
 
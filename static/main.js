@@ -32,6 +32,8 @@ class Stagger {
 
         this.renderTime = null;
         this.data = null;
+        this.eventSource = null;
+        this.tagTable = null;
 
         window.addEventListener("statechange", (event) => {
             this.render();
@@ -46,7 +48,7 @@ class Stagger {
 
             window.history.replaceState(this.request, "", window.location.href);
 
-            this.fetchDataPeriodically();
+            this.watchData();
         });
 
         window.addEventListener("popstate", (event) => {
@@ -62,6 +64,101 @@ class Stagger {
         });
     }
 
+    // The full data comes from /api/data, compressed.  A stream of
+    // server-sent events then sends a delta for each change after its
+    // revision.  The browser reconnects by itself and resumes from
+    // the last event ID.  On a "reset" event, the data is fetched
+    // again.  Fall back to polling if either fails.
+
+    watchData() {
+        if (!window.EventSource) {
+            this.fetchDataPeriodically();
+            return;
+        }
+
+        let request = gesso.openRequest("GET", "/api/data", (event) => {
+            if (event.target.status != 200) {
+                this.fetchDataPeriodically();
+                return;
+            }
+
+            this.data = JSON.parse(event.target.responseText);
+            window.dispatchEvent(new Event("statechange"));
+
+            this.openDataStream(this.data["revision"]);
+        });
+
+        request.addEventListener("error", (event) => {
+            this.fetchDataPeriodically();
+        });
+
+        request.send();
+    }
+
+    openDataStream(revision) {
+        let source = new EventSource(`/api/data?since=${revision}`);
+
+        source.addEventListener("delta", (event) => {
+            let delta = JSON.parse(event.data);
+
+            for (let operation of delta["operations"]) {
+                this.applyOperation(operation);
+            }
+
+            this.data["revision"] = delta["revision"];
+
+            window.dispatchEvent(new Event("statechange"));
+        });
+
+        source.addEventListener("reset", (event) => {
+            console.log("Update stream reset");
+
+            source.close();
+
+            this.eventSource = null;
+            this.watchData();
+        });
+
+        source.addEventListener("error", (event) => {
+            if (source.readyState == EventSource.CLOSED) {
+                console.log("Update stream closed");
+
+                this.eventSource = null;
+                this.fetchDataPeriodically();
+            }
+        });
+
+        this.eventSource = source;
+    }
+
+    applyOperation(operation) {
+        const collections = ["repos", "branches", "tags", "artifacts"];
+
+        let [kind] = operation["op"].split("_", 1);
+        let path = operation["path"];
+        let children = this.data["repos"];
+
+        for (let i = 0; i < path.length - 1; i++) {
+            let obj = children[path[i]];
+
+            if (obj == null) {
+                if (kind == "delete") {
+                    return;
+                }
+
+                obj = children[path[i]] = {[collections[i + 1]]: {}};
+            }
+
+            children = obj[collections[i + 1]];
+        }
+
+        if (kind == "put") {
+            children[path[path.length - 1]] = operation["data"];
+        } else {
+            delete children[path[path.length - 1]];
+        }
+    }
+
     createStateChangeLink(parent, href, options) {
         let elem = gesso.createLink(parent, href, options);
 
@@ -69,7 +166,10 @@ class Stagger {
             event.preventDefault();
 
             this.request.path = new URL(event.target.href).pathname;
-            this.fetchDataPeriodically();
+
+            if (this.eventSource == null) {
+                this.fetchDataPeriodically();
+            }
 
             window.history.pushState(this.request, "", event.target.href);
             window.dispatchEvent(new Event("statechange"));
@@ -182,6 +282,14 @@ class Stagger {
             this.renderArtifactView(content);
             break;
         default:
+            // The main view stays in place, and only its changed
+            // rows are rebuilt
+
+            if (this.tagTable != null && this.tagTable.isConnected) {
+                this.updateTagTable();
+                return;
+            }
+
             this.renderMainView(content);
         }
 
@@ -210,11 +318,16 @@ class Stagger {
     }
 
     renderMainView(parent) {
-        let repos = this.data["repos"];
-
         this.renderHeader(parent, "Stagger", null, {"class": "nameplate"});
 
         let headings = ["Tag", "Build", "Commit", "Updated"];
+
+        this.tagTable = gesso.createTable(parent, headings, [], {"class": "tags"});
+        this.updateTagTable();
+    }
+
+    updateTagTable() {
+        let repos = this.data["repos"];
         let rows = [];
 
         for (let repoId of Object.keys(repos).sort()) {
@@ -228,17 +341,25 @@ class Stagger {
                     let tagData = this.data["repos"][repoId]["branches"][branchId]["tags"][tagId];
                     let tagViewPath = `/tags/${repoId}/${branchId}/${tagId}`
 
-                    rows.push([
-                        this.createStateChangeLink(null, tagViewPath, tag),
-                        this.createOptionalLink(null, tagData["build_url"], tagData["build_id"]),
-                        this.createCommitLink(null, tagData["commit_url"], tagData["commit_id"]),
-                        this.formatTime(tagData["update_time"])
-                    ]);
+                    rows.push({
+                        key: tag,
+                        version: [
+                            tagData["build_url"], tagData["build_id"],
+                            tagData["commit_url"], tagData["commit_id"],
+                            tagData["update_time"]
+                        ].join("\n"),
+                        cells: () => [
+                            this.createStateChangeLink(null, tagViewPath, tag),
+                            this.createOptionalLink(null, tagData["build_url"], tagData["build_id"]),
+                            this.createCommitLink(null, tagData["commit_url"], tagData["commit_id"]),
+                            this.formatTime(tagData["update_time"])
+                        ]
+                    });
                 }
             }
         }
 
-        gesso.createTable(parent, headings, rows, {"class": "tags"});
+        gesso.updateTable(this.tagTable, rows);
     }
 
     renderTagView(parent) {